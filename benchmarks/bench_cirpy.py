@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of CIRpy against a local CIR stand-in server.
+
+Measures throughput and p50/p99 latency of query(), resolve(), Molecule property access and resolve_image(), by
+pointing cirpy.API_BASE at the server in stub_server.py. No network access is needed.
+
+Usage: python benchmarks/bench_cirpy.py [--requests N] [--concurrency N] [--latency S] [--error-rate F] ...
+"""
+
+from __future__ import print_function
+from __future__ import division
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cirpy
+from stub_server import StubServer
+
+
+SCENARIOS = [
+    ('query', lambda i: cirpy.query('compound%s' % i, 'smiles')),
+    ('resolve', lambda i: cirpy.resolve('compound%s' % i, 'smiles')),
+    ('Molecule.smiles', lambda i: cirpy.Molecule('compound%s' % i).smiles),
+    ('Molecule.prefetch',
+     lambda i: cirpy.Molecule('compound%s' % i).prefetch(['smiles', 'stdinchikey', 'formula', 'mw'])),
+    ('resolve_image', lambda i: cirpy.resolve_image('compound%s' % i)),
+]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def run(func, requests, concurrency):
+    """Call func(i) for i in range(requests) from a number of threads. Returns latencies, errors and elapsed time."""
+    latencies, errors = [], []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.time()
+            try:
+                func(i)
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of CIRpy against a local CIR stand-in server.')
+    parser.add_argument('--requests', type=int, default=200, help='calls per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of calling threads')
+    parser.add_argument('--latency', type=float, default=0.005, help='server latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with 500')
+    parser.add_argument('--payload-size', type=int, default=64, help='minimum size in bytes of each value')
+    parser.add_argument('--results', type=int, default=1, help='number of results in each XML response')
+    parser.add_argument('--scenario', action='append', help='only run the named scenarios')
+    args = parser.parse_args()
+
+    server = StubServer(latency=args.latency, error_rate=args.error_rate, payload_size=args.payload_size,
+                        results=args.results).start()
+    cirpy.API_BASE = server.api_base
+    cirpy.configure_pool(per_host=max(4, args.concurrency))
+    print('%-18s %10s %10s %10s %8s' % ('scenario', 'calls/s', 'p50 ms', 'p99 ms', 'errors'))
+    try:
+        for name, func in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            latencies, errors, elapsed = run(func, args.requests, args.concurrency)
+            print('%-18s %10.1f %10.2f %10.2f %8d' % (name, len(latencies) / elapsed, percentile(latencies, 50) * 1000,
+                                                      percentile(latencies, 99) * 1000, len(errors)))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the time taken to ``import cirpy``.
+
+Each measurement is made in a fresh interpreter. The time to import cirpy on its own is compared with the time to also
+import the modules it defers until first use, which is what ``import cirpy`` used to cost. The deferred modules are
+found from the ``_LazyModule`` instances in cirpy, so the list never goes out of date.
+
+Usage: python benchmarks/import_time.py [--runs N]
+"""
+
+from __future__ import print_function
+from __future__ import division
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Accessing any attribute of a _LazyModule imports the module it stands in for
+IMPORT_DEFERRED = ('[getattr(module, "__name__") for module in list(vars(cirpy).values()) '
+                   'if isinstance(module, cirpy._LazyModule)]')
+
+SNIPPET = '''
+import sys, time
+start = time.time()
+import cirpy
+%s
+print(time.time() - start)
+'''
+
+
+def measure(extra, runs):
+    """Return the sorted import times in milliseconds over a number of fresh interpreters."""
+    code = SNIPPET % extra
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    # Compile bytecode up front so that the first run is not slower than the rest
+    subprocess.check_call([sys.executable, '-c', 'import cirpy'], env=env)
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        times.append(float(output) * 1000)
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='number of fresh interpreters to measure')
+    args = parser.parse_args()
+    lazy = measure('', args.runs)
+    eager = measure(IMPORT_DEFERRED, args.runs)
+    print('import cirpy (lazy):          median %6.1f ms   min %6.1f ms' % (lazy[len(lazy) // 2], lazy[0]))
+    print('import cirpy + deferred deps: median %6.1f ms   min %6.1f ms' % (eager[len(eager) // 2], eager[0]))
+    print('saving:                       median %6.1f ms' % (eager[len(eager) // 2] - lazy[len(lazy) // 2]))
+
+
+if __name__ == '__main__':
+    main()
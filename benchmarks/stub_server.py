@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the CIR web service, for offline benchmarks.
+
+Answers ``/chemical/structure/<input>/<representation>[/xml]`` with responses in the same format as CIR, over HTTP/1.1
+keep-alive connections, with configurable latency, error rate and payload size. Can also be run on its own:
+
+    python benchmarks/stub_server.py --port 8000 --latency 0.05
+"""
+
+from __future__ import print_function
+from __future__ import division
+import argparse
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+from xml.sax.saxutils import escape, quoteattr
+
+
+class CIRHandler(BaseHTTPRequestHandler):
+    """Request handler that emulates CIR responses."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        config = self.server.config
+        if config['latency']:
+            time.sleep(config['latency'])
+        if config['error_rate'] and random.random() < config['error_rate']:
+            return self.respond(500, b'Internal Server Error', 'text/html')
+        parts = self.path.split('?')[0].split('/')
+        if len(parts) < 5:
+            return self.respond(404, b'Page not found (404)', 'text/html')
+        input, representation, xml = unquote(parts[3]), parts[4], parts[-1] == 'xml'
+        if representation == 'image':
+            body = b'\x89PNG\r\n\x1a\n' + b'\0' * config['payload_size']
+            return self.respond(200, body, 'image/png')
+        value = ('%s-%s-' % (representation, input)).ljust(config['payload_size'], 'x')
+        if xml:
+            data = ''.join(
+                '<data id="%s" resolver="name_by_cir" string_class="chemical name (CIR)" notation=%s>'
+                '<item id="1">%s</item></data>' % (i + 1, quoteattr(input), escape(value))
+                for i in range(config['results'])
+            )
+            body = '<request string=%s representation=%s>%s</request>' % (
+                quoteattr(input), quoteattr(representation), data)
+            return self.respond(200, body.encode('utf-8'), 'text/xml')
+        self.respond(200, value.encode('utf-8'), 'text/plain')
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server that emulates CIR."""
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0, payload_size=64, results=1):
+        """
+
+        :param tuple address: (Optional) Host and port to listen on (default a free port on localhost)
+        :param float latency: (Optional) Seconds to wait before each response
+        :param float error_rate: (Optional) Fraction of requests that fail with a 500 error
+        :param int payload_size: (Optional) Minimum size in bytes of each result value or image
+        :param int results: (Optional) Number of results in each XML response
+        """
+        HTTPServer.__init__(self, address, CIRHandler)
+        self.config = {'latency': latency, 'error_rate': error_rate, 'payload_size': payload_size, 'results': results}
+
+    @property
+    def api_base(self):
+        """Base URL to use as ``cirpy.API_BASE``."""
+        return 'http://%s:%s/chemical/structure' % self.server_address
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the CIR web service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with 500')
+    parser.add_argument('--payload-size', type=int, default=64, help='minimum size in bytes of each value')
+    parser.add_argument('--results', type=int, default=1, help='number of results in each XML response')
+    args = parser.parse_args()
+    server = StubServer((args.host, args.port), args.latency, args.error_rate, args.payload_size, args.results)
+    print('Serving CIR stand-in at %s' % server.api_base)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,26 +9,69 @@ https://github.com/mcs07/CIRpy
 from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
+import array
+import bisect
+import collections
+import csv
+import errno
 import functools
-import inspect
+import heapq
+import importlib
+import io
 import logging
 import os
+import random
+import sys
+import threading
+import time
+import zlib
 
 try:
-    from urllib.error import HTTPError
-    from urllib.parse import quote, urlencode
-    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import quote, urlencode, urljoin, urlsplit
 except ImportError:
     from urllib import urlencode
-    from urllib2 import quote, urlopen, HTTPError
+    from urllib2 import quote, HTTPError, URLError
+    from urlparse import urljoin, urlsplit
 
-try:
-    from lxml import etree
-except ImportError:
-    try:
-        import xml.etree.cElementTree as etree
-    except ImportError:
-        import xml.etree.ElementTree as etree
+
+class _LazyModule(object):
+    """Proxy for a module that is only imported when one of its attributes is first accessed.
+
+    This keeps ``import cirpy`` fast for short-lived processes that never make a request. Modules that are only needed
+    to make requests or by less common features are deferred; modules that the eager imports load anyway, and csv,
+    which costs well under a millisecond, are imported normally. Alternative module names are tried in order, in the
+    same way as ImportError fallbacks.
+    """
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return getattr(self._module, attr)
+
+
+base64 = _LazyModule('base64')
+gzip = _LazyModule('gzip')
+hashlib = _LazyModule('hashlib')
+etree = _LazyModule('lxml.etree', 'xml.etree.cElementTree', 'xml.etree.ElementTree')
+http_client = _LazyModule('http.client', 'httplib')
+inspect = _LazyModule('inspect')
+json = _LazyModule('json')
+multiprocessing_pool = _LazyModule('multiprocessing.pool')
+queue = _LazyModule('queue', 'Queue')
+socket = _LazyModule('socket')
+sqlite3 = _LazyModule('sqlite3')
+urllib_request = _LazyModule('urllib.request', 'urllib2')
 
 
 __author__ = 'Matt Swain'
@@ -44,6 +87,1615 @@ FILE_FORMATS = {
     'alc', 'cdxml', 'cerius', 'charmm', 'cif', 'cml', 'ctx', 'gjf', 'gromacs', 'hyperchem', 'jme', 'maestro', 'mol',
     'mol2', 'mrv', 'pdb', 'sdf3000', 'sln', 'xyz'
 }
+#: Representations that resolve uses the plain text API for, taking the first line as the first result. Multi-valued
+#: representations such as names and cas use XML, where the values of the first result are kept separate.
+PLAIN_REPRESENTATIONS = FILE_FORMATS | {
+    'stdinchi', 'stdinchikey', 'inchi', 'smiles', 'ficts', 'ficus', 'uuuuu', 'hashisy', 'sdf', 'iupac_name', 'mw',
+    'formula', 'h_bond_donor_count', 'h_bond_acceptor_count', 'h_bond_center_count',
+    'rule_of_5_violation_count', 'rotor_count', 'effective_rotor_count', 'ring_count', 'ringsys_count'
+}
+
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Register a callable that is called with a dict describing each request, cache lookup and parse.
+
+    Every event has ``event``, ``url``, ``representation`` and ``resolvers`` keys, along with:
+
+    - ``request`` events for each request to CIR: ``latency`` in seconds, ``bytes`` received, ``decoded_bytes`` after
+      decompression, HTTP ``status``, number of ``retries`` and ``error`` (None on success).
+    - ``cache`` events for each cache lookup: ``cache`` ("response", "negative" or "query") and ``hit``.
+    - ``parse`` events for each parsed response: ``parse_time`` in seconds and number of ``results``.
+
+    Hooks are called synchronously from the thread making the request, so they should return quickly. Exceptions
+    raised by hooks are logged and otherwise ignored.
+
+    :param hook: Callable that takes a single event dict
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a hook previously registered with :func:`add_hook`."""
+    _hooks.remove(hook)
+
+
+def _emit(event, url, representation=None, resolvers=None, **fields):
+    """Call each registered hook with an event dict.
+
+    The representation and resolvers are passed explicitly by the caller that made the request, rather than parsed
+    from the URL, which can't be split reliably when the input itself contains slashes (e.g. InChI).
+    """
+    if not _hooks:
+        return
+    fields.update(event=event, url=url, representation=representation,
+                  resolvers=list(resolvers) if resolvers else None)
+    for hook in list(_hooks):
+        try:
+            hook(fields)
+        except Exception:
+            log.exception('Error in hook %r', hook)
+
+
+class Histogram(object):
+    """Cumulative histogram of values in fixed buckets."""
+
+    def __init__(self, buckets):
+        """
+
+        :param list(float) buckets: Upper bounds of each bucket, in increasing order
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        """Return a dict with the count, sum and the number of values less than or equal to each bucket bound."""
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class Metrics(object):
+    """Hook that aggregates events into counters and histograms, broken down by representation.
+
+    Register an instance with :func:`add_hook`, then call :meth:`snapshot` to export the current values::
+
+        metrics = cirpy.Metrics()
+        cirpy.add_hook(metrics)
+    """
+
+    #: Upper bounds in seconds of the latency and parse time histogram buckets
+    time_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    #: Upper bounds in bytes of the response size histogram buckets
+    size_buckets = (100, 1000, 10000, 100000, 1000000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+
+    def _histogram(self, name, buckets):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(buckets)
+        return self.histograms[name]
+
+    def __call__(self, event):
+        rep = event['representation']
+        with self._lock:
+            if event['event'] == 'request':
+                self.counters[('requests', rep, event['status'])] += 1
+                self.counters[('retries', rep)] += event['retries']
+                self.counters[('bytes', rep)] += event['bytes']
+                self.counters[('decoded_bytes', rep)] += event['decoded_bytes']
+                self._histogram(('latency', rep), self.time_buckets).observe(event['latency'])
+                self._histogram(('bytes', rep), self.size_buckets).observe(event['bytes'])
+            elif event['event'] == 'cache':
+                self.counters[('cache_hits' if event['hit'] else 'cache_misses', event['cache'])] += 1
+            elif event['event'] == 'parse':
+                self.counters[('results', rep)] += event['results']
+                self._histogram(('parse_time', rep), self.time_buckets).observe(event['parse_time'])
+
+    def snapshot(self):
+        """Return a dict of the current counters and histograms, keyed by tuples of the metric name and labels."""
+        with self._lock:
+            metrics = dict(self.counters)
+            metrics.update((name, histogram.to_dict()) for name, histogram in self.histograms.items())
+            return metrics
+
+    def reset(self):
+        """Reset all counters and histograms."""
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+#: Content codings that transports request when compression is enabled
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class _Decompressor(object):
+    """Streaming decompressor for a gzip or deflate Content-Encoding."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._zlib = None
+
+    def decompress(self, data):
+        if self._zlib is None:
+            wbits = 16 + zlib.MAX_WBITS
+            if self.encoding == 'deflate':
+                # Servers send deflate either with a zlib header, as specified, or as a raw stream
+                head = bytearray(data[:2])
+                zlib_header = len(head) == 2 and head[0] & 0x0f == 8 and (head[0] * 256 + head[1]) % 31 == 0
+                wbits = zlib.MAX_WBITS if zlib_header else -zlib.MAX_WBITS
+            self._zlib = zlib.decompressobj(wbits)
+        return self._zlib.decompress(data)
+
+    def flush(self):
+        return self._zlib.flush() if self._zlib is not None else b''
+
+
+def _decompressor(encoding):
+    """Return a decompressor for a Content-Encoding, or None if the content is not compressed."""
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return _Decompressor('deflate' if encoding == 'deflate' else 'gzip')
+    return None
+
+
+def _decode_body(body, encoding):
+    """Return a complete response body, decompressed according to its Content-Encoding."""
+    decompressor = _decompressor(encoding)
+    return body if decompressor is None else decompressor.decompress(body) + decompressor.flush()
+
+
+_transfer_lock = threading.Lock()
+_transfer = {'bytes_received': 0, 'bytes_decoded': 0}
+
+
+def transfer_stats():
+    """Return a dict with the number of response bytes received from CIR, the number after decompression, and the
+    number saved by compression.
+
+    :rtype: dict
+    """
+    with _transfer_lock:
+        stats = dict(_transfer)
+    stats['bytes_saved'] = stats['bytes_decoded'] - stats['bytes_received']
+    return stats
+
+
+class Transport(object):
+    """Interface for the HTTP client that all requests to CIR go through.
+
+    Subclasses implement :meth:`urlopen`, which makes a GET request and returns a file-like response with ``url``,
+    ``status``, ``headers`` and ``bytes_read`` attributes, a ``read(amt=None)`` method, and a ``close()`` method. The
+    response must also be usable as a context manager. Error responses raise :class:`HTTPError` and connection
+    failures raise :class:`URLError` or :class:`socket.error`, so that they can be retried. Responses that decompress
+    their body should also have a ``decoded_bytes`` attribute, with ``bytes_read`` counting the compressed bytes.
+
+    Use :func:`set_transport` to change the transport used by CIRpy.
+    """
+
+    def urlopen(self, url, headers=None, hedge=False, cancellation=None):
+        """Make a GET request and return a file-like response.
+
+        Transports that limit connections may let hedged requests use reserved capacity, and may abort a request
+        when its cancellation is cancelled. Other transports can ignore these arguments.
+
+        :param string url: URL to request
+        :param dict headers: (Optional) Additional request headers
+        :param bool hedge: (Optional) Whether this is a duplicate request sent by hedging
+        :param cancellation: (Optional) Cancellation that aborts the request when cancelled
+        :raises HTTPError: if the server returns an error code
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the transport."""
+
+
+class _DecodingReader(object):
+    """Mixin for file-like responses that decompresses the body as it is read.
+
+    ``bytes_read`` counts the bytes received and ``decoded_bytes`` counts the bytes after decompression. A read may
+    return more than ``amt`` bytes of decompressed data.
+    """
+
+    def _init_decoding(self, encoding):
+        self._decompressor = _decompressor(encoding)
+        self.bytes_read = 0
+        self.decoded_bytes = 0
+
+    def read(self, amt=None):
+        while True:
+            data = self._read_raw(amt)
+            self.bytes_read += len(data)
+            if self._decompressor is not None:
+                if data:
+                    data = self._decompressor.decompress(data)
+                    if not data:
+                        continue
+                else:
+                    data, self._decompressor = self._decompressor.flush(), None
+            self.decoded_bytes += len(data)
+            return data
+
+
+class BufferedResponse(_DecodingReader):
+    """File-like HTTP response with a body that has already been read in full."""
+
+    def __init__(self, url, status, headers, body, encoding=None):
+        """
+
+        :param string encoding: (Optional) Content-Encoding of the body, which is decompressed as it is read
+        """
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self._stream = io.BytesIO(body)
+        self._init_decoding(encoding)
+
+    def _read_raw(self, amt):
+        return self._stream.read(amt) if amt is not None else self._stream.read()
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PooledResponse(_DecodingReader):
+    """File-like HTTP response that hands its connection back to the pool when closed.
+
+    A gzip or deflate compressed body is decompressed as it is read.
+    """
+
+    def __init__(self, pool, key, connection, response, url, hedge=False, cancellation=None):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._hedge = hedge
+        self._cancellation = cancellation
+        self._init_decoding(self.headers.get('Content-Encoding'))
+
+    def _read_raw(self, amt):
+        return self._response.read(amt)
+
+    def close(self):
+        """Release the connection. It is only reused if the response body was read in full."""
+        if self._connection is None:
+            return
+        reuse = self._response.isclosed() and not self._response.will_close
+        if self._cancellation is not None:
+            reuse = self._cancellation.unregister() and reuse
+        self._response.close()
+        self._pool.release(self._key, self._connection, reuse, self._hedge)
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool(Transport):
+    """Thread-safe pool of persistent keep-alive HTTP(S) connections.
+
+    This is the default transport. A single pool is shared by :func:`request`, :func:`resolve_image` and
+    :class:`Molecule` so that consecutive queries reuse warm connections instead of paying for a new TCP and TLS
+    handshake each time. The pool connects directly, so when a proxy is configured in the environment, requests are
+    made with :class:`UrllibTransport` instead.
+    """
+
+    #: HTTP status codes that are followed as redirects
+    redirect_codes = {301, 302, 303, 307, 308}
+
+    def __init__(self, maxsize=10, per_host=4, idle_timeout=60, timeout=30, compress=True, hedge_slots=4):
+        """
+
+        :param int maxsize: (Optional) Maximum number of idle connections kept open in total
+        :param int per_host: (Optional) Maximum number of simultaneous connections to a single host
+        :param float idle_timeout: (Optional) Seconds after which an unused connection is discarded
+        :param float timeout: (Optional) Socket timeout in seconds
+        :param bool compress: (Optional) Whether to request gzip or deflate compressed responses
+        :param int hedge_slots: (Optional) Connections to a single host reserved for hedged requests, in addition to
+                                ``per_host``
+        """
+        self.maxsize = maxsize
+        self.per_host = per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.compress = compress
+        self.hedge_slots = hedge_slots
+        self._proxy_transport = (None, None)
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._active = {}
+
+    def acquire(self, key, hedge=False, cancellation=None):
+        """Return a ``(connection, reused)`` tuple for the given ``(scheme, host, port)`` key.
+
+        Blocks while the per-host connection limit is reached. Hedged requests have their own limit of
+        ``hedge_slots``, so they never wait behind the requests they are meant to replace.
+
+        :raises _Cancelled: if the cancellation is cancelled while waiting
+        """
+        active_key, limit = ((key, 'hedge'), self.hedge_slots) if hedge else (key, self.per_host)
+        if cancellation is not None:
+            cancellation.register(self._wake)
+        with self._lock:
+            while self._active.get(active_key, 0) >= limit:
+                if cancellation is not None and cancellation.cancelled:
+                    raise _Cancelled()
+                self._lock.wait()
+            if cancellation is not None and cancellation.cancelled:
+                raise _Cancelled()
+            self._active[active_key] = self._active.get(active_key, 0) + 1
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if time.time() - last_used < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        scheme, host, port = key
+        cls = http_client.HTTPSConnection if scheme == 'https' else http_client.HTTPConnection
+        return cls(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection, reuse=True, hedge=False):
+        """Return a connection to the pool, or close it if it cannot be reused or the pool is full."""
+        with self._lock:
+            self._active[(key, 'hedge') if hedge else key] -= 1
+            if reuse and sum(len(idle) for idle in self._idle.values()) < self.maxsize:
+                self._idle.setdefault(key, []).append((connection, time.time()))
+                connection = None
+            self._lock.notify_all()
+        if connection is not None:
+            connection.close()
+
+    def _wake(self):
+        """Wake threads waiting for a connection, so that cancelled requests stop waiting."""
+        with self._lock:
+            self._lock.notify_all()
+
+    def urlopen(self, url, headers=None, hedge=False, cancellation=None, redirects=5):
+        """Make a GET request and return a :class:`PooledResponse`.
+
+        When the cancellation is cancelled, the connection is shut down so that a request waiting for its response
+        fails immediately and the connection is not reused.
+
+        :param string url: URL to request
+        :param dict headers: (Optional) Additional request headers
+        :param bool hedge: (Optional) Whether this is a duplicate request sent by hedging
+        :param cancellation: (Optional) Cancellation that aborts the request when cancelled
+        :param int redirects: (Optional) Maximum number of redirects to follow
+        :rtype: PooledResponse
+        :raises HTTPError: if the server returns an error code, or a redirect without a location
+        :raises URLError: if the connection fails
+        """
+        proxies = urllib_request.getproxies()
+        if proxies:
+            # The global urllib opener reads the proxy settings only once, so use one built for the current settings
+            if self._proxy_transport[0] != proxies:
+                opener = urllib_request.build_opener(urllib_request.ProxyHandler(proxies))
+                self._proxy_transport = (proxies, UrllibTransport(self.timeout, self.compress, opener))
+            return self._proxy_transport[1].urlopen(url, headers)
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = '%s?%s' % (parts.path, parts.query) if parts.query else parts.path
+        request_headers = dict(headers or {})
+        if self.compress:
+            request_headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+        while True:
+            connection, reused = self.acquire(key, hedge, cancellation)
+            if cancellation is not None and not cancellation.register(functools.partial(_shutdown, connection)):
+                self.release(key, connection, False, hedge)
+                raise _Cancelled()
+            try:
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+                break
+            except (socket.error, http_client.HTTPException) as e:
+                if cancellation is not None:
+                    cancellation.unregister()
+                self.release(key, connection, False, hedge)
+                if cancellation is not None and cancellation.cancelled:
+                    raise _Cancelled()
+                # The server may have dropped an idle keep-alive connection, so retry on a fresh one
+                if not reused:
+                    # Raise the same error as urllib for connection failures
+                    if isinstance(e, socket.error) and not isinstance(e, URLError):
+                        raise URLError(e)
+                    raise
+                log.debug('Stale pooled connection to %s, reconnecting', key[1])
+        response = PooledResponse(self, key, connection, response, url, hedge, cancellation)
+        if response.status in self.redirect_codes:
+            location = response.headers.get('Location')
+            body = response.read()
+            response.close()
+            if location is None or redirects <= 0:
+                reason = 'Redirect without a Location header' if location is None else 'Too many redirects'
+                raise HTTPError(url, response.status, reason, response.headers, io.BytesIO(body))
+            return self.urlopen(urljoin(url, location), headers, hedge, cancellation, redirects - 1)
+        if response.status >= 400:
+            body = response.read()
+            response.close()
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+
+class UrllibTransport(Transport):
+    """Transport that makes each request with :func:`urllib.request.urlopen`, without reusing connections."""
+
+    def __init__(self, timeout=30, compress=True, opener=None):
+        """
+
+        :param float timeout: (Optional) Socket timeout in seconds
+        :param bool compress: (Optional) Whether to request gzip or deflate compressed responses
+        :param opener: (Optional) urllib ``OpenerDirector`` to use instead of the global opener
+        """
+        self.timeout = timeout
+        self.compress = compress
+        self.opener = opener
+
+    def urlopen(self, url, headers=None, hedge=False, cancellation=None):
+        request_headers = dict(headers or {})
+        if self.compress:
+            request_headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+        open_url = self.opener.open if self.opener is not None else urllib_request.urlopen
+        try:
+            response = open_url(urllib_request.Request(url, headers=request_headers), timeout=self.timeout)
+        except HTTPError as e:
+            # Error responses are compressed too, so decompress the body before passing the error on
+            body = e.read() if e.fp is not None else b''
+            raise HTTPError(url, e.code, e.msg, e.hdrs, io.BytesIO(_decode_body(body, e.hdrs.get('Content-Encoding'))))
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        headers = response.info()
+        return BufferedResponse(url, response.getcode(), headers, body, headers.get('Content-Encoding'))
+
+
+class HttpxTransport(Transport):
+    """Transport that uses an `httpx`_ client, which supports HTTP/2 and connection pooling. Requires httpx.
+
+    .. _`httpx`: https://www.python-httpx.org
+    """
+
+    def __init__(self, http2=True, max_connections=10, timeout=30, compress=True):
+        """
+
+        :param bool http2: (Optional) Whether to use HTTP/2 where the server supports it (requires the h2 package)
+        :param int max_connections: (Optional) Maximum number of simultaneous connections
+        :param float timeout: (Optional) Timeout in seconds for each request
+        :param bool compress: (Optional) Whether to request gzip or deflate compressed responses
+        """
+        import httpx
+        self._httpx = httpx
+        self._client = httpx.Client(http2=http2, timeout=timeout, follow_redirects=True,
+                                    limits=httpx.Limits(max_connections=max_connections))
+        self.compress = compress
+
+    def urlopen(self, url, headers=None, hedge=False, cancellation=None):
+        request_headers = dict(headers or {})
+        request_headers.setdefault('Accept-Encoding', ACCEPT_ENCODING if self.compress else 'identity')
+        try:
+            # Read the raw body so that bytes received are counted before decompression
+            with self._client.stream('GET', url, headers=request_headers) as response:
+                body = b''.join(response.iter_raw())
+        except self._httpx.TransportError as e:
+            raise socket.error(str(e))
+        encoding = response.headers.get('Content-Encoding')
+        if response.status_code >= 400:
+            raise HTTPError(url, response.status_code, response.reason_phrase, response.headers,
+                            io.BytesIO(_decode_body(body, encoding)))
+        return BufferedResponse(url, response.status_code, response.headers, body, encoding)
+
+    def close(self):
+        self._client.close()
+
+
+class RecordingTransport(Transport):
+    """Transport that passes requests to another transport and appends each response to a file.
+
+    Successful and error responses are recorded as JSON Lines with a base64-encoded body, so they can be served back
+    by :class:`ReplayTransport` without network access.
+    """
+
+    def __init__(self, path, transport=None):
+        """
+
+        :param string path: Path of the file to append responses to
+        :param Transport transport: (Optional) Transport that makes the real requests, defaults to the current one
+        """
+        self.path = path
+        self.transport = transport or _transport
+        self._lock = threading.Lock()
+
+    def _record(self, url, status, body):
+        line = json.dumps({'url': url, 'status': status, 'body': base64.b64encode(body).decode('ascii')})
+        with self._lock:
+            with io.open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + u'\n')
+
+    def urlopen(self, url, headers=None, hedge=False, cancellation=None):
+        try:
+            with self.transport.urlopen(url, headers, hedge, cancellation) as response:
+                body = response.read()
+        except HTTPError as e:
+            body = e.read()
+            self._record(url, e.code, body)
+            raise HTTPError(url, e.code, e.msg, e.hdrs, io.BytesIO(body))
+        self._record(url, response.status, body)
+        return BufferedResponse(url, response.status, response.headers, body)
+
+    def close(self):
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    """Transport that serves responses previously saved by :class:`RecordingTransport`, without network access.
+
+    If a URL was recorded more than once, the most recent response is used.
+    """
+
+    def __init__(self, path, fallback=None):
+        """
+
+        :param string path: Path of the file of recorded responses
+        :param Transport fallback: (Optional) Transport for URLs that were not recorded
+        :raises KeyError: from :meth:`urlopen` if a URL was not recorded and there is no fallback
+        """
+        self.path = path
+        self.fallback = fallback
+        self.responses = {}
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record['url']] = (record['status'], base64.b64decode(record['body']))
+
+    def urlopen(self, url, headers=None, hedge=False, cancellation=None):
+        if url not in self.responses:
+            if self.fallback is not None:
+                return self.fallback.urlopen(url, headers, hedge, cancellation)
+            raise KeyError('No recorded response for %s' % url)
+        status, body = self.responses[url]
+        if status >= 400:
+            raise HTTPError(url, status, 'Recorded error', {}, io.BytesIO(body))
+        return BufferedResponse(url, status, {}, body)
+
+
+_transport = ConnectionPool()
+
+
+def set_transport(transport):
+    """Set the transport used for all requests to CIR, and return the previous one.
+
+    The previous transport is not closed, so it can be restored or wrapped by the new one::
+
+        previous = cirpy.set_transport(cirpy.RecordingTransport('responses.jsonl'))
+
+    :param Transport transport: The transport to use
+    :rtype: Transport
+    """
+    global _transport
+    previous, _transport = _transport, transport
+    return previous
+
+
+def get_transport():
+    """Return the transport used for all requests to CIR.
+
+    :rtype: Transport
+    """
+    return _transport
+
+
+def configure_pool(maxsize=10, per_host=4, idle_timeout=60, timeout=30, compress=True, hedge_slots=4):
+    """Replace the transport used for all requests to CIR with a new connection pool, and close the old transport.
+
+    :param int maxsize: (Optional) Maximum number of idle connections kept open in total
+    :param int per_host: (Optional) Maximum number of simultaneous connections to a single host
+    :param float idle_timeout: (Optional) Seconds after which an unused connection is discarded
+    :param float timeout: (Optional) Socket timeout in seconds
+    :param bool compress: (Optional) Whether to request gzip or deflate compressed responses
+    :param int hedge_slots: (Optional) Connections to a single host reserved for hedged requests, in addition to
+                            ``per_host``
+    """
+    set_transport(ConnectionPool(maxsize, per_host, idle_timeout, timeout, compress, hedge_slots)).close()
+
+
+class ResponseCache(object):
+    """Persistent SQLite-backed store of CIR responses keyed by URL.
+
+    Entries expire after ``ttl`` seconds, and the least recently used entries are evicted once there are more than
+    ``maxsize``. The cache can safely be shared between threads and processes.
+    """
+
+    #: Name of the SQLite table that holds the entries
+    table = 'responses'
+    #: Name of the cache in events passed to hooks
+    name = 'response'
+    #: Seconds before the access time of an entry is updated again, so that most hits don't write to the database.
+    #: Least recently used order is only accurate to within this interval.
+    touch_interval = 60
+
+    def __init__(self, path, ttl=2592000, maxsize=100000):
+        """
+
+        :param string path: SQLite database file path
+        :param float ttl: (Optional) Seconds before an entry expires, or None to never expire (default 30 days)
+        :param int maxsize: (Optional) Maximum number of entries, or None for no limit
+        """
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS %s '
+                             '(url TEXT PRIMARY KEY, body BLOB, created REAL, accessed REAL)' % self.table)
+            self._db.execute('CREATE INDEX IF NOT EXISTS %s_accessed ON %s (accessed)' % (self.table, self.table))
+
+    def get(self, url, **context):
+        """Return the cached response body for url, or None if it is missing or expired.
+
+        Any keyword arguments, such as representation and resolvers, are passed on to hooks in the cache event.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT body, created, accessed FROM %s WHERE url = ?' % self.table,
+                                   (url,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM %s WHERE url = ?' % self.table, (url,))
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                if now - row[2] >= self.touch_interval:
+                    self._db.execute('UPDATE %s SET accessed = ? WHERE url = ?' % self.table, (now, url))
+                self.hits += 1
+        _emit('cache', url, cache=self.name, hit=row is not None, **context)
+        return bytes(row[0]) if row is not None else None
+
+    def set(self, url, body):
+        """Store the response body for url, evicting the least recently used entries if necessary."""
+        now = time.time()
+        with self._lock, self._db:
+            updated = self._db.execute('UPDATE %s SET body = ?, created = ?, accessed = ? WHERE url = ?' % self.table,
+                                       (sqlite3.Binary(body), now, now, url)).rowcount
+            if not updated:
+                self._db.execute('INSERT INTO %s (url, body, created, accessed) VALUES (?, ?, ?, ?)' % self.table,
+                                 (url, sqlite3.Binary(body), now, now))
+            # Other processes may share the database, so count the entries rather than tracking them in memory
+            size = self._count() if self.maxsize is not None and not updated else None
+            if size is not None and size > self.maxsize:
+                self._db.execute('DELETE FROM %s WHERE url IN (SELECT url FROM %s ORDER BY accessed LIMIT ?)'
+                                 % (self.table, self.table), (size - self.maxsize,))
+
+    def _count(self):
+        """Return the number of stored entries."""
+        return self._db.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def stats(self):
+        """Return a dict with the number of cache hits, misses and stored entries."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': self._count()}
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM %s' % self.table)
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
+
+class NegativeCache(ResponseCache):
+    """Store of requests that could not be resolved, so that repeats fail fast without contacting CIR.
+
+    A 404 error is stored with an empty body, and an XML response without any results is stored as is. Entries
+    usually have a shorter lifetime than those in the :class:`ResponseCache`. By default the store is held in memory.
+    """
+
+    table = 'negative_responses'
+    name = 'negative'
+
+    def __init__(self, path=':memory:', ttl=86400, maxsize=100000):
+        """
+
+        :param string path: (Optional) SQLite database file path (default in memory)
+        :param float ttl: (Optional) Seconds before an entry expires, or None to never expire (default 1 day)
+        :param int maxsize: (Optional) Maximum number of entries, or None for no limit
+        """
+        super(NegativeCache, self).__init__(path, ttl, maxsize)
+
+
+_cache = None
+_negative_cache = None
+
+
+def enable_cache(path, ttl=2592000, maxsize=100000):
+    """Cache CIR responses in a SQLite database so that repeated requests are read locally.
+
+    :param string path: SQLite database file path
+    :param float ttl: (Optional) Seconds before an entry expires, or None to never expire (default 30 days)
+    :param int maxsize: (Optional) Maximum number of entries, or None for no limit
+    """
+    global _cache
+    disable_cache()
+    _cache = ResponseCache(path, ttl, maxsize)
+
+
+def disable_cache():
+    """Stop caching CIR responses and close the cache database."""
+    global _cache
+    old_cache, _cache = _cache, None
+    if old_cache is not None:
+        old_cache.close()
+
+
+def cache_stats():
+    """Return a dict with the number of hits, misses and stored entries for the response cache.
+
+    :returns: Cache statistics, or None if caching is not enabled
+    :rtype: dict or None
+    """
+    return _cache.stats() if _cache is not None else None
+
+
+def _results_size(results):
+    """Return the approximate number of bytes of text held by a list of Results."""
+    size = 0
+    for result in results:
+        for value in (result.input, result.notation, result.input_format, result.resolver, result.representation):
+            size += len(value or '')
+        size += sum(len(v or '') for v in result.value) if isinstance(result.value, list) else len(result.value or '')
+    return size
+
+
+class QueryCache(object):
+    """Thread-safe in-memory least recently used cache of parsed query results, keyed by URL.
+
+    The cache is bounded both by number of entries and by the approximate size of the text it holds.
+    """
+
+    def __init__(self, maxsize=1024, maxbytes=None):
+        """
+
+        :param int maxsize: (Optional) Maximum number of entries, or 0 to disable caching
+        :param int maxbytes: (Optional) Maximum approximate size in bytes of all cached results, or None for no limit
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url, alternate=None, **context):
+        """Return a copy of the cached list of Results for url, or for the alternate URL if given, or None.
+
+        Any keyword arguments, such as representation and resolvers, are passed on to hooks in the cache event.
+        """
+        if not self.maxsize:
+            return None
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is None and alternate is not None:
+                entry = self._entries.pop(alternate, None)
+                url = alternate if entry is not None else url
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries[url] = entry
+                self.hits += 1
+        _emit('cache', url, cache='query', hit=entry is not None, **context)
+        return list(entry[0]) if entry is not None else None
+
+    def set(self, url, results):
+        """Store a list of Results for url, evicting the least recently used entries if necessary."""
+        if not self.maxsize:
+            return
+        size = _results_size(results)
+        with self._lock:
+            old_entry = self._entries.pop(url, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[1]
+            self._entries[url] = (list(results), size)
+            self._bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.maxsize or
+                                 (self.maxbytes is not None and self._bytes > self.maxbytes)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+
+    def resize(self, maxsize=1024, maxbytes=None):
+        """Change the size limits, evicting entries if necessary."""
+        with self._lock:
+            self.maxsize = maxsize
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dict with the number of hits, misses, entries and bytes, and the size limits."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'bytes': self._bytes,
+                    'maxsize': self.maxsize, 'maxbytes': self.maxbytes}
+
+
+_query_cache = QueryCache(maxsize=0)
+
+
+def configure_query_cache(maxsize=1024, maxbytes=None):
+    """Set the size of the in-memory cache of parsed :func:`query` results. It is disabled by default.
+
+    :param int maxsize: (Optional) Maximum number of entries, or 0 to disable caching
+    :param int maxbytes: (Optional) Maximum approximate size in bytes of all cached results, or None for no limit
+    """
+    _query_cache.resize(maxsize, maxbytes)
+
+
+def clear_query_cache():
+    """Remove all entries from the in-memory query cache."""
+    _query_cache.clear()
+
+
+def query_cache_stats():
+    """Return a dict with the number of hits, misses, entries and bytes, and the size limits of the query cache.
+
+    :rtype: dict
+    """
+    return _query_cache.stats()
+
+
+def enable_negative_cache(path=':memory:', ttl=86400, maxsize=100000):
+    """Remember inputs that could not be resolved, so that repeated requests for them fail fast without contacting CIR.
+
+    Both 404 errors and XML responses without any results are remembered.
+
+    :param string path: (Optional) SQLite database file path (default in memory)
+    :param float ttl: (Optional) Seconds before an entry expires, or None to never expire (default 1 day)
+    :param int maxsize: (Optional) Maximum number of entries, or None for no limit
+    """
+    global _negative_cache
+    disable_negative_cache()
+    _negative_cache = NegativeCache(path, ttl, maxsize)
+
+
+def disable_negative_cache():
+    """Stop remembering inputs that could not be resolved."""
+    global _negative_cache
+    old_cache, _negative_cache = _negative_cache, None
+    if old_cache is not None:
+        old_cache.close()
+
+
+def negative_cache_stats():
+    """Return a dict with the number of hits, misses and stored entries for the negative cache.
+
+    :returns: Cache statistics, or None if negative caching is not enabled
+    :rtype: dict or None
+    """
+    return _negative_cache.stats() if _negative_cache is not None else None
+
+
+class RateLimiter(object):
+    """Thread-safe token bucket that limits the rate and concurrency of requests to CIR.
+
+    The rate adapts to throttling: it is halved (down to ``min_rate``) whenever CIR responds with 429 or 503, then
+    recovers by ``recovery`` requests per second after each successful response until it is back at ``rate``.
+    """
+
+    #: HTTP status codes that indicate the server is throttling requests
+    throttle_codes = {429, 503}
+
+    def __init__(self, rate=10, burst=None, max_concurrency=None, min_rate=0.5, recovery=0.1):
+        """
+
+        :param float rate: (Optional) Maximum requests per second, or None for no rate limit
+        :param int burst: (Optional) Maximum number of requests allowed in a burst (default 1 second worth)
+        :param int max_concurrency: (Optional) Maximum number of simultaneous requests, or None for no limit
+        :param float min_rate: (Optional) Lowest rate the limiter will adapt down to
+        :param float recovery: (Optional) Requests per second the rate recovers by after each successful response
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.current_rate = rate
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def acquire(self):
+        """Block until a request may be made."""
+        if self._slots is not None:
+            self._slots.acquire()
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.current_rate)
+            self._updated = now
+            # Reserve a token now, and wait for the deficit to refill if there is one
+            self._tokens -= 1
+            wait = -self._tokens / self.current_rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self, status):
+        """Record the HTTP status of a completed request, adapting the rate, and free its concurrency slot."""
+        if self.rate is not None:
+            with self._lock:
+                if status in self.throttle_codes:
+                    self.current_rate = max(self.min_rate, self.current_rate / 2)
+                    log.debug('Throttled by CIR, reducing rate to %.2f/s', self.current_rate)
+                elif status < 400:
+                    self.current_rate = min(self.rate, self.current_rate + self.recovery)
+        if self._slots is not None:
+            self._slots.release()
+
+
+_limiter = None
+
+
+def enable_rate_limit(rate=10, burst=None, max_concurrency=None, min_rate=0.5, recovery=0.1):
+    """Limit the rate and concurrency of all requests to CIR, adapting to throttling responses.
+
+    :param float rate: (Optional) Maximum requests per second, or None for no rate limit
+    :param int burst: (Optional) Maximum number of requests allowed in a burst (default 1 second worth)
+    :param int max_concurrency: (Optional) Maximum number of simultaneous requests, or None for no limit
+    :param float min_rate: (Optional) Lowest rate the limiter will adapt down to
+    :param float recovery: (Optional) Requests per second the rate recovers by after each successful response
+    """
+    global _limiter
+    _limiter = RateLimiter(rate, burst, max_concurrency, min_rate, recovery)
+
+
+def disable_rate_limit():
+    """Stop limiting the rate of requests to CIR."""
+    global _limiter
+    _limiter = None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request while the circuit breaker is open."""
+
+
+class RetryPolicy(object):
+    """Policy for retrying failed requests with exponential backoff and jitter."""
+
+    #: HTTP status codes that are retried by default
+    retry_codes = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30, jitter=True, retry_codes=None, deadline=None):
+        """
+
+        :param int max_attempts: (Optional) Maximum number of attempts for each request, including the first
+        :param float backoff: (Optional) Delay in seconds before the first retry, doubled for each subsequent retry
+        :param float max_backoff: (Optional) Maximum delay in seconds between attempts
+        :param bool jitter: (Optional) Whether to randomize each delay between zero and its full value
+        :param set(int) retry_codes: (Optional) HTTP status codes to retry (default 429, 500, 502, 503 and 504)
+        :param float deadline: (Optional) Maximum total seconds to spend on a request before giving up
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        if retry_codes is not None:
+            self.retry_codes = set(retry_codes)
+        self.deadline = deadline
+
+    def is_retryable(self, error):
+        """Return whether a request that raised error should be retried. Connection errors are always retryable."""
+        if isinstance(error, HTTPError):
+            return error.code in self.retry_codes
+        return True
+
+    def delay(self, attempt, error=None):
+        """Return the delay in seconds before the next attempt, after the given number of failed attempts.
+
+        A ``Retry-After`` header in an HTTP error response is respected as a minimum.
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = error.headers.get('Retry-After') if isinstance(error, HTTPError) and error.headers else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
+
+
+class CircuitBreaker(object):
+    """Thread-safe circuit breaker that stops requests to CIR for a cool-down period after sustained failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and requests fail immediately with
+    :class:`CircuitOpenError`. Once ``cooldown`` seconds have passed a single trial request is allowed through, which
+    closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=30):
+        """
+
+        :param int failure_threshold: (Optional) Number of consecutive failures that opens the circuit
+        :param float cooldown: (Optional) Seconds to wait before allowing a trial request
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """Raise CircuitOpenError unless a request may be made."""
+        with self._lock:
+            if self.opened is None:
+                return
+            if time.time() - self.opened < self.cooldown or self._trial:
+                raise CircuitOpenError('Circuit breaker is open after %s consecutive failures' % self.failures)
+            self._trial = True
+
+    def record_success(self):
+        """Record a successful request, closing the circuit."""
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def record_failure(self):
+        """Record a failed request, opening the circuit if the failure threshold is reached."""
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened is None and self.failures >= self.failure_threshold):
+                log.warning('Opening circuit breaker for %ss after %s consecutive failures', self.cooldown,
+                            self.failures)
+                self.opened = time.time()
+            self._trial = False
+
+
+_retry_policy = None
+_breaker = None
+
+
+def enable_retries(max_attempts=3, backoff=0.5, max_backoff=30, jitter=True, retry_codes=None, deadline=None):
+    """Retry requests to CIR that fail with a connection error or a transient HTTP error.
+
+    :param int max_attempts: (Optional) Maximum number of attempts for each request, including the first
+    :param float backoff: (Optional) Delay in seconds before the first retry, doubled for each subsequent retry
+    :param float max_backoff: (Optional) Maximum delay in seconds between attempts
+    :param bool jitter: (Optional) Whether to randomize each delay between zero and its full value
+    :param set(int) retry_codes: (Optional) HTTP status codes to retry (default 429, 500, 502, 503 and 504)
+    :param float deadline: (Optional) Maximum total seconds to spend on a request before giving up
+    """
+    global _retry_policy
+    _retry_policy = RetryPolicy(max_attempts, backoff, max_backoff, jitter, retry_codes, deadline)
+
+
+def disable_retries():
+    """Stop retrying failed requests."""
+    global _retry_policy
+    _retry_policy = None
+
+
+def enable_circuit_breaker(failure_threshold=5, cooldown=30):
+    """Stop sending requests to CIR for a cool-down period after sustained failures.
+
+    :param int failure_threshold: (Optional) Number of consecutive failures that opens the circuit
+    :param float cooldown: (Optional) Seconds to wait before allowing a trial request
+    """
+    global _breaker
+    _breaker = CircuitBreaker(failure_threshold, cooldown)
+
+
+def disable_circuit_breaker():
+    """Stop using the circuit breaker."""
+    global _breaker
+    _breaker = None
+
+
+class HedgePolicy(object):
+    """Policy for sending a duplicate request when a response is slow, to cut tail latency.
+
+    If no response has arrived after the ``percentile`` latency of recent requests, a second identical request is
+    sent and whichever finishes first is used. The other is cancelled, which closes its connection immediately, even
+    if it is still waiting for a response. Duplicate requests use connections reserved by the connection pool's
+    ``hedge_slots``, so they do not wait behind the requests they replace. To cap the extra load on CIR, at most
+    ``max_ratio`` of requests are hedged.
+    """
+
+    def __init__(self, percentile=95, initial_delay=1, min_delay=0.01, max_delay=None, max_ratio=0.1,
+                 min_samples=20, window=1000):
+        """
+
+        :param float percentile: (Optional) Percentile of recent latencies after which a duplicate request is sent
+        :param float initial_delay: (Optional) Delay in seconds used until enough latencies have been observed
+        :param float min_delay: (Optional) Minimum delay in seconds before a duplicate request is sent
+        :param float max_delay: (Optional) Maximum delay in seconds before a duplicate request is sent
+        :param float max_ratio: (Optional) Maximum number of duplicate requests as a fraction of all requests
+        :param int min_samples: (Optional) Number of latencies to observe before the percentile is used
+        :param int window: (Optional) Number of recent latencies the percentile is calculated from
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Return the delay in seconds before a duplicate request is sent."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            delay = self.initial_delay
+        else:
+            delay = latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+        delay = max(delay, self.min_delay)
+        return min(delay, self.max_delay) if self.max_delay is not None else delay
+
+    def observe(self, latency):
+        """Record the latency in seconds of a successful request."""
+        with self._lock:
+            self._latencies.append(latency)
+
+    def allow_hedge(self):
+        """Return whether a duplicate request may be sent without exceeding ``max_ratio``, and count it if so."""
+        with self._lock:
+            if self.hedges + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def stats(self):
+        """Return a dict with the number of requests, duplicate requests sent, and duplicate requests that won."""
+        with self._lock:
+            return {'requests': self.requests, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
+
+
+_hedge_policy = None
+
+
+def enable_hedging(percentile=95, initial_delay=1, min_delay=0.01, max_delay=None, max_ratio=0.1, min_samples=20,
+                   window=1000):
+    """Send a duplicate request when a response from CIR is slower than usual, and use whichever finishes first.
+
+    Downloads streamed to disk are never hedged.
+
+    :param float percentile: (Optional) Percentile of recent latencies after which a duplicate request is sent
+    :param float initial_delay: (Optional) Delay in seconds used until enough latencies have been observed
+    :param float min_delay: (Optional) Minimum delay in seconds before a duplicate request is sent
+    :param float max_delay: (Optional) Maximum delay in seconds before a duplicate request is sent
+    :param float max_ratio: (Optional) Maximum number of duplicate requests as a fraction of all requests
+    :param int min_samples: (Optional) Number of latencies to observe before the percentile is used
+    :param int window: (Optional) Number of recent latencies the percentile is calculated from
+    """
+    global _hedge_policy
+    _hedge_policy = HedgePolicy(percentile, initial_delay, min_delay, max_delay, max_ratio, min_samples, window)
+
+
+def disable_hedging():
+    """Stop sending duplicate requests."""
+    global _hedge_policy
+    _hedge_policy = None
+
+
+def hedging_stats():
+    """Return a dict with the number of requests, duplicate requests sent, and duplicate requests that won.
+
+    :rtype: dict
+    """
+    return _hedge_policy.stats() if _hedge_policy is not None else None
+
+
+def _read_all(response):
+    return response.read()
+
+
+class _LocalError(Exception):
+    """Wraps a local I/O error raised while consuming a response, so that it is not retried as a connection error."""
+
+    def __init__(self, error):
+        super(_LocalError, self).__init__(error)
+        self.error = error
+
+
+def _local(func, *args):
+    """Call func, wrapping any I/O error it raises in :class:`_LocalError`."""
+    try:
+        return func(*args)
+    except EnvironmentError as e:
+        raise _LocalError(e)
+
+
+class _Cancelled(Exception):
+    """Raised inside a request that was cancelled, such as a hedged request that lost the race."""
+
+
+def _shutdown(connection):
+    """Shut down the socket of a connection, so that any thread blocked reading from it fails immediately."""
+    sock = connection.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class _Cancellation(object):
+    """Thread-safe token that aborts an in-flight request by calling its registered callback when cancelled."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callback = None
+        self._lock = threading.Lock()
+
+    def register(self, callback):
+        """Set the callback that aborts the request. Returns False, without registering, if already cancelled."""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._callback = callback
+            return True
+
+    def unregister(self):
+        """Remove the callback. Returns False if the request was cancelled."""
+        with self._lock:
+            self._callback = None
+            return not self.cancelled
+
+    def cancel(self):
+        """Cancel the request, calling the callback if one is registered."""
+        with self._lock:
+            self.cancelled = True
+            callback, self._callback = self._callback, None
+        if callback is not None:
+            callback()
+
+
+class _Scheduler(object):
+    """Single background thread that calls functions after a delay, so that requests don't each need a thread to wait
+    for a deadline. Scheduled functions run on the scheduler thread, so they must return quickly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._heap = []
+        self._count = 0
+        self._thread = None
+
+    def schedule(self, delay, func):
+        """Call func after delay seconds, unless cancelled first. Returns an entry to pass to :meth:`cancel`."""
+        with self._lock:
+            self._count += 1
+            entry = [time.time() + delay, self._count, func]
+            heapq.heappush(self._heap, entry)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='cirpy-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._lock.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Stop a scheduled function from being called, if it hasn't been already."""
+        with self._lock:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._lock.wait(self._heap[0][0] - time.time() if self._heap else None)
+                func = heapq.heappop(self._heap)[2]
+            if func is not None:
+                try:
+                    func()
+                except Exception:
+                    log.exception('Error in scheduled function %r', func)
+
+
+_scheduler = _Scheduler()
+
+
+def _read_url_hedged(url, policy, info):
+    """Request url from CIR and return the response body, sending a duplicate request if the first is slow.
+
+    The original request is made in the calling thread. Only if it is still running after the hedging delay is a
+    thread started for the duplicate, and whichever request loses is aborted by closing its connection.
+
+    :raises HTTPError: if both requests fail, the error from the original request
+    """
+    with policy._lock:
+        policy.requests += 1
+    cancellations = [_Cancellation(), _Cancellation()]
+    hedge_result = queue.Queue()
+    state = {'done': False, 'hedged': False}
+    lock = threading.Lock()
+
+    def attempt_hedge():
+        hedge_info = {}
+        hedge_start = time.time()
+        try:
+            body = _read_url_limited(url, _read_all, hedge_info, True, cancellations[1])
+        except Exception as e:
+            hedge_result.put((e, None, hedge_info, hedge_start))
+        else:
+            # Abort the original request, closing its connection even if it is still waiting for a response
+            cancellations[0].cancel()
+            hedge_result.put((None, body, hedge_info, hedge_start))
+
+    def hedge():
+        with lock:
+            if state['done'] or not policy.allow_hedge():
+                return
+            state['hedged'] = True
+        log.debug('Request is slow, sending a duplicate: %s', url)
+        thread = threading.Thread(target=attempt_hedge)
+        thread.daemon = True
+        thread.start()
+
+    entry = _scheduler.schedule(policy.delay(), hedge)
+    attempt_info = {}
+    start = time.time()
+    error = None
+    try:
+        body = _read_url_limited(url, _read_all, attempt_info, False, cancellations[0])
+    except Exception as e:
+        error = e
+    _scheduler.cancel(entry)
+    with lock:
+        state['done'] = True
+        hedged = state['hedged']
+    if error is None:
+        if hedged:
+            cancellations[1].cancel()
+        policy.observe(time.time() - start)
+        info.update(attempt_info)
+        return body
+    if hedged:
+        hedge_error, body, hedge_info, hedge_start = hedge_result.get()
+        if hedge_error is None:
+            policy.observe(time.time() - hedge_start)
+            with policy._lock:
+                policy.hedge_wins += 1
+            info.update(hedge_info)
+            return body
+    info.update(attempt_info)
+    raise error
+
+
+def _read_url(url, consume=_read_all, **context):
+    """Request url from CIR and return the response body, retrying according to the retry policy.
+
+    If given, consume is called with the open response instead of reading the whole body, and its return value is
+    returned. It is called again from scratch for each retry. Any keyword arguments, such as representation and
+    resolvers, are passed on to hooks in the request event.
+
+    :raises HTTPError: if CIR returns an error code
+    :raises CircuitOpenError: if the circuit breaker is open
+    """
+    policy, breaker, hedge_policy = _retry_policy, _breaker, _hedge_policy
+    start = time.time()
+    attempt = 0
+    info = {'status': None, 'bytes': 0, 'decoded_bytes': 0}
+    while True:
+        attempt += 1
+        try:
+            if breaker is not None:
+                breaker.before_request()
+            if hedge_policy is not None and consume is _read_all:
+                body = _read_url_hedged(url, hedge_policy, info)
+            else:
+                body = _read_url_limited(url, consume, info)
+        except _LocalError as e:
+            # Errors such as a full disk while consuming the response are not CIR failures
+            raise e.error
+        except (socket.error, URLError, http_client.HTTPException, CircuitOpenError) as e:
+            if isinstance(e, CircuitOpenError):
+                _emit('request', url, latency=time.time() - start, retries=attempt - 1, error=e,
+                      **dict(context, **info))
+                raise
+            # Only server and connection errors count as failures, not errors such as 404 for unresolvable inputs
+            retryable = (policy or RetryPolicy()).is_retryable(e)
+            if breaker is not None and retryable:
+                breaker.record_failure()
+            elif breaker is not None:
+                breaker.record_success()
+            delay = policy.delay(attempt, e) if policy is not None and retryable else None
+            if (delay is None or attempt >= policy.max_attempts or
+                    (policy.deadline is not None and time.time() - start + delay > policy.deadline)):
+                _emit('request', url, latency=time.time() - start, retries=attempt - 1, error=e,
+                      **dict(context, **info))
+                raise
+            log.debug('Request failed (%s), retrying in %.2fs: %s', e, delay, url)
+            time.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            _emit('request', url, latency=time.time() - start, retries=attempt - 1, error=None,
+                  **dict(context, **info))
+            return body
+
+
+def _read_url_limited(url, consume=_read_all, info=None, hedge=False, cancellation=None):
+    """Request url from CIR, subject to the rate limit, and return the response body.
+
+    If given, the info dict is updated with the HTTP status and number of bytes received.
+
+    :raises HTTPError: if CIR returns an error code
+    """
+    info = info if info is not None else {}
+    limiter = _limiter
+    if limiter is not None:
+        limiter.acquire()
+    info['status'], info['bytes'], info['decoded_bytes'] = 599, 0, 0
+    try:
+        with _transport.urlopen(url, hedge=hedge, cancellation=cancellation) as response:
+            body = consume(response)
+        info['status'], info['bytes'] = response.status, response.bytes_read
+        info['decoded_bytes'] = getattr(response, 'decoded_bytes', response.bytes_read)
+        with _transfer_lock:
+            _transfer['bytes_received'] += info['bytes']
+            _transfer['bytes_decoded'] += info['decoded_bytes']
+        return body
+    except HTTPError as e:
+        info['status'] = e.code
+        raise
+    finally:
+        if limiter is not None:
+            limiter.release(info['status'])
+
+
+class _Call(object):
+    """An in-flight call whose result is shared by all callers of :meth:`_SingleFlight.do`."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.body = None
+
+    def raise_error(self):
+        """Raise the error, giving each caller its own HTTPError because the response body can only be read once."""
+        if self.body is not None:
+            e = self.error
+            raise HTTPError(e.filename, e.code, e.msg, e.hdrs, io.BytesIO(self.body))
+        raise self.error
+
+
+class _SingleFlight(object):
+    """Deduplicate concurrent calls with the same key, so only one is made and every caller receives its result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Call func, unless a call with the same key is already in flight, in which case wait for its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            log.debug('Waiting for in-flight request: %s', key)
+            call.event.wait()
+            if call.error is not None:
+                call.raise_error()
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except HTTPError as e:
+            call.error, call.body = e, e.read() if e.fp is not None else b''
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        call.raise_error()
+
+
+_inflight = _SingleFlight()
+
+
+def _fetch(url, xml=False, **context):
+    """Return the response body for url, from the response caches if possible.
+
+    :param string url: URL to request
+    :param bool xml: (Optional) Whether this is an XML request, where a response without results is cached as negative
+    :param context: (Optional) Representation and resolvers that were requested, for hook events
+    :raises HTTPError: if CIR returns an error code
+    """
+    cache, negative_cache = _cache, _negative_cache
+    if negative_cache is not None:
+        body = negative_cache.get(url, **context)
+        if body is not None:
+            log.debug('Negative cache hit: %s', url)
+            if not body:
+                raise HTTPError(url, 404, 'Not Found (cached)', {}, io.BytesIO())
+            return body
+    if cache is not None:
+        body = cache.get(url, **context)
+        if body is not None:
+            log.debug('Cache hit: %s', url)
+            return body
+    return _inflight.do(url, lambda: _fetch_uncached(url, xml, cache, negative_cache, context))
+
+
+def _fetch_uncached(url, xml, cache, negative_cache, context):
+    """Request url from CIR and store the response in the caches."""
+    try:
+        body = _read_url(url, **context)
+    except HTTPError as e:
+        if e.code == 404 and negative_cache is not None:
+            negative_cache.set(url, b'')
+        raise
+    # CIR returns an XML document without any <data> elements when the input cannot be resolved
+    if xml and negative_cache is not None and b'<data' not in body:
+        negative_cache.set(url, body)
+    elif cache is not None:
+        cache.set(url, body)
+    return body
 
 
 def construct_api_url(input, representation, resolvers=None, get3d=False, tautomers=False, xml=True, **kwargs):
@@ -92,13 +1744,14 @@ def request(input, representation, resolvers=None, get3d=False, tautomers=False,
     """
     url = construct_api_url(input, representation, resolvers, get3d, tautomers, **kwargs)
     log.debug('Making request: %s', url)
-    response = urlopen(url)
-    return etree.parse(response).getroot()
+    return etree.fromstring(_fetch(url, xml=True, representation=representation, resolvers=resolvers))
 
 
 class Result(object):
     """A single result returned by CIR."""
 
+    __slots__ = ('input', 'representation', 'resolver', 'input_format', 'notation', 'value')
+
     def __init__(self, input, notation, input_format, resolver, representation, value):
         """
 
@@ -125,11 +1778,14 @@ class Result(object):
         return self.value
 
     def __eq__(self, other):
-        return isinstance(other, type(self)) and self.__dict__ == other.__dict__
+        return isinstance(other, type(self)) and self._astuple() == other._astuple()
+
+    def __ne__(self, other):
+        return not self == other
 
     def __getitem__(self, prop):
         """Allow dict-style access to attributes to ease transition from when results were dicts."""
-        if prop in self.__dict__:
+        if prop in self.__slots__:
             return getattr(self, prop)
         raise KeyError(prop)
 
@@ -139,11 +1795,107 @@ class Result(object):
 
     def __contains__(self, prop):
         """Allow dict-style checking of attributes to ease transition from when results were dicts."""
-        return prop in self.__dict__
+        return prop in self.__slots__
+
+    def __getstate__(self):
+        return self._astuple()
+
+    def __setstate__(self, state):
+        for prop, val in zip(self.__slots__, state):
+            setattr(self, prop, val)
+
+    def _astuple(self):
+        return tuple(getattr(self, prop) for prop in self.__slots__)
 
     def to_dict(self):
         """Return a dictionary containing Result data."""
-        return self.__dict__
+        return dict(zip(self.__slots__, self._astuple()))
+
+
+class ResultSet(object):
+    """Compact column-oriented container for a large number of Results.
+
+    Each attribute is stored in its own list, and the highly repetitive resolver, representation and input format
+    strings are interned so that each distinct value is only held once. Indexing or iterating returns Result objects
+    that are constructed on demand.
+    """
+
+    #: Attributes that are interned
+    interned = ('representation', 'resolver', 'input_format')
+
+    def __init__(self, results=()):
+        """
+
+        :param results: (Optional) Initial results
+        :type results: iterable(Result)
+        """
+        self._columns = dict((prop, []) for prop in Result.__slots__)
+        self._strings = {}
+        self.extend(results)
+
+    def append(self, result):
+        """Add a Result."""
+        for prop in Result.__slots__:
+            val = getattr(result, prop)
+            if prop in self.interned:
+                val = self._strings.setdefault(val, val)
+            self._columns[prop].append(val)
+
+    def extend(self, results):
+        """Add each Result in an iterable."""
+        for result in results:
+            self.append(result)
+
+    def column(self, prop):
+        """Return a list of the values of a single attribute for all Results."""
+        return list(self._columns[prop])
+
+    def __len__(self):
+        return len(self._columns['value'])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ResultSet(self[i] for i in range(*index.indices(len(self))))
+        return Result(**dict((prop, self._columns[prop][index]) for prop in Result.__slots__))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'ResultSet(%s results)' % len(self)
+
+    def to_csv(self, f):
+        """Write all Results to a file in CSV format with a header row. Multiple values are separated by newlines.
+
+        :param f: Text file object to write to
+        """
+        if sys.version_info[0] < 3:
+            # The Python 2 csv module only writes byte strings, so encode each row and write it as text
+            buffer = io.BytesIO()
+            writer = csv.writer(buffer)
+
+            def writerow(row):
+                writer.writerow([val.encode('utf-8') if isinstance(val, type('')) else val for val in row])
+                f.write(buffer.getvalue().decode('utf-8'))
+                buffer.seek(0)
+                buffer.truncate()
+        else:
+            writerow = csv.writer(f).writerow
+        writerow(Result.__slots__)
+        columns = [self._columns[prop] for prop in Result.__slots__]
+        for row in zip(*columns):
+            writerow(['\n'.join(val) if isinstance(val, list) else val for val in row])
+
+    def to_jsonl(self, f):
+        """Write all Results to a file in JSON Lines format, one object per line.
+
+        :param f: Text file object to write to
+        """
+        columns = [self._columns[prop] for prop in Result.__slots__]
+        for row in zip(*columns):
+            # Formatting into a unicode literal makes the ASCII str from json.dumps on Python 2 text
+            f.write('%s\n' % json.dumps(dict(zip(Result.__slots__, row))))
 
 
 def query(input, representation, resolvers=None, get3d=False, tautomers=False, **kwargs):
@@ -159,26 +1911,72 @@ def query(input, representation, resolvers=None, get3d=False, tautomers=False, *
     :raises HTTPError: if CIR returns an error code
     :raises ParseError: if CIR response is uninterpretable
     """
-    tree = request(input, representation, resolvers, get3d, tautomers, **kwargs)
-    results = []
-    for data in tree.findall('.//data'):
-        value = [item.text for item in data.findall('item')]
-        result = Result(
-            input=tree.attrib['string'],
-            representation=tree.attrib['representation'],
-            resolver=data.attrib['resolver'],
-            input_format=data.attrib['string_class'],
-            notation=data.attrib['notation'],
-            value=value[0] if len(value) == 1 else value
-        )
-        results.append(result)
+    url = construct_api_url(input, representation, resolvers, get3d, tautomers, **kwargs)
+    context = {'representation': representation, 'resolvers': resolvers}
+    results = _query_cache.get(url, **context)
+    if results is None:
+        log.debug('Making request: %s', url)
+        body = _fetch(url, xml=True, **context)
+        start = time.time()
+        results = list(_iter_results(body))
+        _emit('parse', url, parse_time=time.time() - start, results=len(results), **context)
+        _query_cache.set(url, results)
     log.debug('Received %s query results', len(results))
     return results
 
 
+def query_iter(input, representation, resolvers=None, get3d=False, tautomers=False, **kwargs):
+    """Iterate over all results for resolving input to the specified output representation.
+
+    The response is parsed incrementally, and each result is yielded as soon as it has been parsed, so there is no
+    need to build the full XML tree or list of results if only some of them are needed.
+
+    :param string input: Chemical identifier to resolve
+    :param string representation: Desired output representation
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :param bool tautomers: (Optional) Whether to return all tautomers
+    :returns: Iterator of resolved results
+    :rtype: iterator(Result)
+    :raises HTTPError: if CIR returns an error code
+    :raises ParseError: if CIR response is uninterpretable
+    """
+    url = construct_api_url(input, representation, resolvers, get3d, tautomers, **kwargs)
+    context = {'representation': representation, 'resolvers': resolvers}
+    results = _query_cache.get(url, **context)
+    if results is not None:
+        return iter(results)
+    log.debug('Making request: %s', url)
+    return _iter_results(_fetch(url, xml=True, **context))
+
+
+def _iter_results(body):
+    """Parse a CIR XML response incrementally, yielding each Result as soon as its <data> element is complete."""
+    root = None
+    # Event names must be native strings, as cElementTree on Python 2 rejects unicode ones
+    for event, elem in etree.iterparse(io.BytesIO(body), events=(str('start'), str('end'))):
+        if root is None:
+            root = elem
+            input, representation = elem.attrib['string'], elem.attrib['representation']
+        elif event == 'end' and elem.tag == 'data':
+            value = [item.text for item in elem.findall('item')]
+            yield Result(
+                input=input,
+                representation=representation,
+                resolver=elem.attrib['resolver'],
+                input_format=elem.attrib['string_class'],
+                notation=elem.attrib['notation'],
+                value=value[0] if len(value) == 1 else value
+            )
+            # Discard consumed elements so memory use doesn't grow with the number of results
+            root.clear()
+
+
 def resolve(input, representation, resolvers=None, get3d=False, **kwargs):
     """Resolve input to the specified output representation.
 
+    For the common representations in :data:`PLAIN_REPRESENTATIONS`, the plain text API is used instead of XML.
+
     :param string input: Chemical identifier to resolve
     :param string representation: Desired output representation
     :param list(string) resolvers: (Optional) Ordered list of resolvers to use
@@ -188,10 +1986,112 @@ def resolve(input, representation, resolvers=None, get3d=False, **kwargs):
     :raises HTTPError: if CIR returns an error code
     :raises ParseError: if CIR response is uninterpretable
     """
-    # Take first result from XML query
-    results = query(input, representation, resolvers, False, get3d, **kwargs)
-    result = results[0].value if results else None
-    return result
+    if representation not in PLAIN_REPRESENTATIONS:
+        # Take first result from XML query
+        result = next(query_iter(input, representation, resolvers, get3d, **kwargs), None)
+        return result.value if result is not None else None
+    # Use a previously resolved value, or a previously parsed XML query result, if one is cached
+    url = construct_api_url(input, representation, resolvers, get3d, xml=False, **kwargs)
+    context = {'representation': representation, 'resolvers': resolvers}
+    results = _query_cache.get(url, construct_api_url(input, representation, resolvers, get3d, **kwargs), **context)
+    if results is not None:
+        return results[0].value if results else None
+    # Otherwise the plain text response contains just the first result, and is smaller and faster to decode than XML
+    log.debug('Making plain request: %s', url)
+    try:
+        body = _fetch(url, **context)
+    except HTTPError as e:
+        # CIR responds with 404 when the input cannot be resolved
+        if e.code == 404:
+            return None
+        raise
+    start = time.time()
+    value = _decode_plain(body, representation)
+    _emit('parse', url, parse_time=time.time() - start, results=int(value is not None), **context)
+    _query_cache.set(url, [Result(input, None, None, None, representation, value)] if value is not None else [])
+    return value
+
+
+def _decode_plain(body, representation):
+    """Return the value of a plain text CIR response.
+
+    CIR returns one line for each match, so only the first line is used, in the same way that :func:`resolve` uses
+    the first XML result.
+    """
+    text = body.decode('utf-8')
+    if representation in FILE_FORMATS or representation == 'sdf':
+        return text or None
+    lines = text.splitlines()
+    return lines[0] if lines else None
+
+
+def _imap(func, iterable, max_workers):
+    """Apply func to each item of iterable in a pool of worker threads, yielding results in input order.
+
+    Only a bounded window of items is in flight at once, so long iterables are consumed lazily.
+    """
+    workers = multiprocessing_pool.ThreadPool(max_workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(workers.apply_async(func, (item,)))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        workers.terminate()
+
+
+def _capture_errors(func):
+    """Wrap func so that HTTPError and ParseError are returned instead of raised."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (HTTPError, etree.ParseError) as e:
+            log.debug('Captured error for %r: %s', args, e)
+            return e
+    return wrapper
+
+
+def query_many(inputs, representation, resolvers=None, get3d=False, tautomers=False, max_workers=4, **kwargs):
+    """Query many inputs concurrently using a pool of worker threads.
+
+    Errors for individual inputs are captured and returned in place of their results, so a single failure does not
+    abort the whole batch.
+
+    :param inputs: Chemical identifiers to resolve
+    :type inputs: iterable(string)
+    :param string representation: Desired output representation
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :param bool tautomers: (Optional) Whether to return all tautomers
+    :param int max_workers: (Optional) Maximum number of simultaneous requests
+    :returns: List of results for each input, in input order
+    :rtype: list(list(Result) or HTTPError or ParseError)
+    """
+    func = _capture_errors(lambda input: query(input, representation, resolvers, get3d, tautomers, **kwargs))
+    return list(_imap(func, inputs, max_workers))
+
+
+def resolve_many(inputs, representation, resolvers=None, get3d=False, max_workers=4, **kwargs):
+    """Resolve many inputs concurrently using a pool of worker threads.
+
+    Errors for individual inputs are captured and returned in place of their results, so a single failure does not
+    abort the whole batch.
+
+    :param inputs: Chemical identifiers to resolve
+    :type inputs: iterable(string)
+    :param string representation: Desired output representation
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :param int max_workers: (Optional) Maximum number of simultaneous requests
+    :returns: Output representation, None, or the error raised for each input, in input order
+    :rtype: list(string or None or HTTPError or ParseError)
+    """
+    func = _capture_errors(lambda input: resolve(input, representation, resolvers, get3d, **kwargs))
+    return list(_imap(func, inputs, max_workers))
 
 
 def resolve_image(input, resolvers=None, fmt='png', width=300, height=300, frame=False, crop=None, bgcolor=None,
@@ -231,6 +2131,13 @@ def resolve_image(input, resolvers=None, fmt='png', width=300, height=300, frame
     for arg in args:
         if values[arg] is not None:
             kwargs[arg] = values[arg]
+    url = _image_url(kwargs)
+    log.debug('Making image request: %s', url)
+    return _fetch(url, representation='image', resolvers=resolvers)
+
+
+def _image_url(kwargs):
+    """Return the CIR image URL for the aggregated arguments of :func:`resolve_image`."""
     # Turn off anti-aliasing for transparent background
     if kwargs.get('bgcolor') == 'transparent':
         kwargs['antialiasing'] = False
@@ -245,10 +2152,82 @@ def resolve_image(input, resolvers=None, fmt='png', width=300, height=300, frame
         kwargs.update({'wedges': status, 'dashes': status})
     # Constant values
     kwargs.update({'representation': 'image', 'xml': False})
-    url = construct_api_url(**kwargs)
-    log.debug('Making image request: %s', url)
-    response = urlopen(url)
-    return response.read()
+    return construct_api_url(**kwargs)
+
+
+def _image_args(input, resolvers, kwargs):
+    """Return the arguments of :func:`resolve_image` for input, with defaults applied and None values removed."""
+    spec = (getattr(inspect, 'getfullargspec', None) or inspect.getargspec)(resolve_image)
+    args = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    args.update(kwargs, input=input, resolvers=resolvers)
+    return dict((k, v) for k, v in args.items() if v is not None)
+
+
+class ImageStore(object):
+    """Content-addressed on-disk store of 2D image depictions.
+
+    Each image is saved in a file named after a hash of the input, resolvers and normalized rendering parameters, so
+    the same depiction is only ever requested once and can be shared between processes.
+    """
+
+    def __init__(self, directory):
+        """
+
+        :param string directory: Directory to store images in, which is created if necessary
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, args):
+        """Return the file path for the aggregated arguments of :func:`resolve_image`."""
+        key = hashlib.sha256(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], '%s.%s' % (key, args['fmt']))
+
+    def get(self, input, resolvers=None, **kwargs):
+        """Return the path of the image file for input, requesting it from CIR if it is not already stored.
+
+        Accepts the same rendering options as :func:`resolve_image`, with the same defaults.
+
+        :param string input: Chemical identifier to resolve
+        :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+        :returns: File path, or None if nothing resolved
+        :rtype: string or None
+        :raises HTTPError: if CIR returns an error code
+        """
+        args = _image_args(input, resolvers, kwargs)
+        path = self.path(args)
+        if os.path.isfile(path):
+            return path
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another thread or process may have created it
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        url = _image_url(dict(args))
+        log.debug('Making image request: %s', url)
+        return path if _stream_to_file(url, path, text=False, representation='image', resolvers=resolvers) else None
+
+
+def resolve_images(inputs, directory, resolvers=None, max_workers=4, **kwargs):
+    """Resolve many inputs to 2D image depictions concurrently, and save them in a content-addressed directory.
+
+    Accepts the same rendering options as :func:`resolve_image`, with the same defaults. Images that are already in
+    the directory with the same rendering options are not requested again. Errors for individual inputs are captured
+    and returned in place of their file paths.
+
+    :param inputs: Chemical identifiers to resolve
+    :type inputs: iterable(string)
+    :param string directory: Directory to store images in, which is created if necessary
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param int max_workers: (Optional) Maximum number of simultaneous requests
+    :returns: File path, None if nothing resolved, or the error raised for each input, in input order
+    :rtype: list(string or None or HTTPError)
+    """
+    store = ImageStore(directory)
+    return list(_imap(_capture_errors(lambda input: store.get(input, resolvers, **kwargs)), inputs, max_workers))
 
 
 # TODO: Support twirl as fmt paramter?
@@ -259,7 +2238,9 @@ def resolve_image(input, resolvers=None, fmt='png', width=300, height=300, frame
 def download(input, filename, representation, overwrite=False, resolvers=None, get3d=False, **kwargs):
     """Convenience function to save a CIR response as a file.
 
-    This is just a simple wrapper around the resolve function.
+    For file formats, the response is streamed to a temporary file in chunks and then renamed into place, so the whole
+    file is never held in memory and a partial file is never left behind. Other representations save the first result
+    only, in the same way as :func:`resolve`.
 
     :param string input: Chemical identifier to resolve
     :param string filename: File path to save to
@@ -271,14 +2252,20 @@ def download(input, filename, representation, overwrite=False, resolvers=None, g
     :raises ParseError: if CIR response is uninterpretable
     :raises IOError: if overwrite is False and file already exists
     """
+    # Only overwrite an existing file if explicitly instructed to.
+    if not overwrite and os.path.isfile(filename):
+        raise IOError("%s already exists. Use 'overwrite=True' to overwrite it." % filename)
+    if representation in FILE_FORMATS or representation == 'sdf':
+        url = construct_api_url(input, representation, resolvers, get3d, xml=False, **kwargs)
+        log.debug('Making download request: %s', url)
+        if not _stream_to_file(url, filename, representation=representation, resolvers=resolvers):
+            log.debug('No file to download.')
+        return
     result = resolve(input, representation, resolvers, get3d, **kwargs)
     # Just log and return if nothing resolved
     if not result:
         log.debug('No file to download.')
         return
-    # Only overwrite an existing file if explicitly instructed to.
-    if not overwrite and os.path.isfile(filename):
-        raise IOError("%s already exists. Use 'overwrite=True' to overwrite it." % filename)
     # Ensure file ends with a newline
     if not result.endswith('\n'):
         result += '\n'
@@ -286,6 +2273,102 @@ def download(input, filename, representation, overwrite=False, resolvers=None, g
         f.write(result)
 
 
+#: Size in bytes of the chunks in which downloads are written to disk
+DOWNLOAD_CHUNK_SIZE = 65536
+
+
+def _temp_file(filename):
+    """Create a uniquely named temporary file in the same directory as filename, and return ``(fd, path)``.
+
+    Unlike mkstemp, which creates files readable only by their owner, the file is created with mode 0666 so that the
+    umask is applied and it gets the same permissions as a normally created file once it is renamed into place.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    while True:
+        path = os.path.join(directory, '.cirpy-%016x' % random.getrandbits(64))
+        try:
+            return os.open(path, flags, 0o666), path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _stream_to_file(url, filename, text=True, **context):
+    """Stream the response for url to a temporary file, then atomically rename it to filename.
+
+    Text files are given a trailing newline if they do not already end with one. Any keyword arguments, such as
+    representation and resolvers, are passed on to hooks in the request event.
+
+    :returns: Whether anything was resolved and saved
+    :rtype: bool
+    """
+    fd, temp_filename = _temp_file(filename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            def consume(response):
+                _local(f.seek, 0)
+                _local(f.truncate)
+                last = b''
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    _local(f.write, chunk)
+                    last = chunk
+                return last
+            try:
+                last = _read_url(url, consume, **context)
+            except HTTPError as e:
+                # CIR responds with 404 when the input cannot be resolved
+                if e.code == 404:
+                    last = b''
+                else:
+                    raise
+            # Ensure file ends with a newline
+            if text and last and not last.endswith(b'\n'):
+                f.write(b'\n')
+        if not last:
+            os.remove(temp_filename)
+            return False
+        getattr(os, 'replace', os.rename)(temp_filename, filename)
+        return True
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def download_many(inputs, directory, representation, overwrite=False, resolvers=None, get3d=False, max_workers=4,
+                  **kwargs):
+    """Save CIR responses for many inputs concurrently, as one file per input in a directory.
+
+    Each file is named after the URL-quoted input with the representation as its extension. Existing files are skipped
+    unless overwrite is True. Errors for individual inputs are captured and returned in place of their file paths.
+
+    :param inputs: Chemical identifiers to resolve
+    :type inputs: iterable(string)
+    :param string directory: Directory to save files in, which is created if necessary
+    :param string representation: Desired output representation
+    :param bool overwrite: (Optional) Whether to overwrite existing files
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :param int max_workers: (Optional) Maximum number of simultaneous requests
+    :returns: File path, None if nothing resolved, or the error raised for each input, in input order
+    :rtype: list(string or None or HTTPError or ParseError)
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    @_capture_errors
+    def download_one(input):
+        filename = os.path.join(directory, '%s.%s' % (quote(input, safe=''), representation))
+        if not overwrite and os.path.isfile(filename):
+            log.debug('Skipping existing file: %s', filename)
+            return filename
+        download(input, filename, representation, True, resolvers, get3d, **kwargs)
+        return filename if os.path.isfile(filename) else None
+
+    return list(_imap(download_one, inputs, max_workers))
+
+
 def memoized_property(fget):
     """Decorator to create memoized properties."""
     attr_name = '_{0}'.format(fget.__name__)
@@ -295,9 +2378,400 @@ def memoized_property(fget):
         if not hasattr(self, attr_name):
             setattr(self, attr_name, fget(self))
         return getattr(self, attr_name)
+    fget_memoized.memoized_attr = attr_name
     return property(fget_memoized)
 
 
+class IdentityIndex(object):
+    """Thread-safe index that shares structure-level properties between Molecules with the same structure.
+
+    Properties are stored per alias, which is an input and list of resolvers. Once the Standard InChIKey of an alias
+    is known, the alias is linked to a single store for that InChIKey, so each property is resolved once per
+    structure rather than once per input.
+
+    Standard InChIKeys do not distinguish some tautomers, so inputs that are different tautomers of the same compound
+    share a single SMILES.
+    """
+
+    def __init__(self, fetch_key=True):
+        """
+
+        :param bool fetch_key: (Optional) Whether to resolve the Standard InChIKey of a new alias before its first
+                               shared property, so that values already resolved for the same structure are reused
+        """
+        self.fetch_key = fetch_key
+        self.hits = 0
+        self.misses = 0
+        self._aliases = {}
+        self._structures = {}
+        self._linked = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def alias(molecule):
+        """Return the alias of a Molecule."""
+        return molecule.input, tuple(molecule.resolvers) if molecule.resolvers else None
+
+    def get(self, molecule, name, fget):
+        """Return the value of a shared property for a Molecule, calling fget to resolve it if it is not known."""
+        alias = self.alias(molecule)
+        if self.fetch_key and name != 'stdinchikey' and alias not in self._linked:
+            molecule.stdinchikey
+        with self._lock:
+            store = self._aliases.setdefault(alias, {})
+            if name in store:
+                self.hits += 1
+                return store[name]
+            self.misses += 1
+        value = fget(molecule)
+        with self._lock:
+            value = store.setdefault(name, value)
+        if name == 'stdinchikey' and value:
+            self.link(alias, value)
+        return value
+
+    def link(self, alias, stdinchikey):
+        """Share the properties of an alias with all other aliases of the structure with the given InChIKey."""
+        with self._lock:
+            structure = self._structures.setdefault(stdinchikey, {})
+            for name, value in self._aliases.get(alias, {}).items():
+                structure.setdefault(name, value)
+            self._aliases[alias] = structure
+            self._linked.add(alias)
+
+    def clear(self):
+        """Remove all aliases and properties from the index."""
+        with self._lock:
+            self._aliases.clear()
+            self._structures.clear()
+            self._linked.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dict with the number of hits, misses, aliases and structures in the index."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'aliases': len(self._aliases),
+                    'structures': len(self._structures)}
+
+
+_identity_index = None
+
+
+def enable_identity_index(fetch_key=True):
+    """Share structure-level :class:`Molecule` properties between all Molecules with the same Standard InChIKey.
+
+    Properties such as ``smiles``, ``mw``, ``formula`` and the counts are then resolved once per structure, however
+    many different inputs (names, CAS numbers, SMILES) are used for it. Molecules with extra query parameters are not
+    shared.
+
+    :param bool fetch_key: (Optional) Whether to resolve the Standard InChIKey of a new input before its first shared
+                           property, so that values already resolved for the same structure are reused
+    """
+    global _identity_index
+    _identity_index = IdentityIndex(fetch_key)
+
+
+def disable_identity_index():
+    """Stop sharing properties between Molecules."""
+    global _identity_index
+    _identity_index = None
+
+
+def identity_index_stats():
+    """Return a dict with the number of hits, misses, aliases and structures in the identity index, or None.
+
+    :rtype: dict
+    """
+    return _identity_index.stats() if _identity_index is not None else None
+
+
+#: Element symbols and standard atomic weights, in order of atomic number
+ELEMENTS = (
+    ('H', 1.00794), ('He', 4.002602), ('Li', 6.941), ('Be', 9.012182), ('B', 10.811), ('C', 12.0107),
+    ('N', 14.0067), ('O', 15.9994), ('F', 18.9984032), ('Ne', 20.1797), ('Na', 22.98976928), ('Mg', 24.305),
+    ('Al', 26.9815386), ('Si', 28.0855), ('P', 30.973762), ('S', 32.065), ('Cl', 35.453), ('Ar', 39.948),
+    ('K', 39.0983), ('Ca', 40.078), ('Sc', 44.955912), ('Ti', 47.867), ('V', 50.9415), ('Cr', 51.9961),
+    ('Mn', 54.938045), ('Fe', 55.845), ('Co', 58.933195), ('Ni', 58.6934), ('Cu', 63.546), ('Zn', 65.38),
+    ('Ga', 69.723), ('Ge', 72.64), ('As', 74.9216), ('Se', 78.96), ('Br', 79.904), ('Kr', 83.798),
+    ('Rb', 85.4678), ('Sr', 87.62), ('Y', 88.90585), ('Zr', 91.224), ('Nb', 92.90638), ('Mo', 95.96),
+    ('Tc', 98.0), ('Ru', 101.07), ('Rh', 102.9055), ('Pd', 106.42), ('Ag', 107.8682), ('Cd', 112.411),
+    ('In', 114.818), ('Sn', 118.71), ('Sb', 121.76), ('Te', 127.6), ('I', 126.90447), ('Xe', 131.293),
+    ('Cs', 132.9054519), ('Ba', 137.327), ('La', 138.90547), ('Ce', 140.116), ('Pr', 140.90765), ('Nd', 144.242),
+    ('Pm', 145.0), ('Sm', 150.36), ('Eu', 151.964), ('Gd', 157.25), ('Tb', 158.92535), ('Dy', 162.5),
+    ('Ho', 164.93032), ('Er', 167.259), ('Tm', 168.93421), ('Yb', 173.054), ('Lu', 174.9668), ('Hf', 178.49),
+    ('Ta', 180.94788), ('W', 183.84), ('Re', 186.207), ('Os', 190.23), ('Ir', 192.217), ('Pt', 195.084),
+    ('Au', 196.966569), ('Hg', 200.59), ('Tl', 204.3833), ('Pb', 207.2), ('Bi', 208.9804), ('Po', 209.0),
+    ('At', 210.0), ('Rn', 222.0), ('Fr', 223.0), ('Ra', 226.0), ('Ac', 227.0), ('Th', 232.03806),
+    ('Pa', 231.03588), ('U', 238.02891),
+)
+
+_ATOMIC_NUMBERS = dict((symbol, number) for number, (symbol, _) in enumerate(ELEMENTS, 1))
+
+#: Allowed valences used to add implicit hydrogens. Charged atoms use the valences of the isoelectronic element.
+_VALENCES = {'He': (0,), 'B': (3,), 'C': (4,), 'N': (3, 5), 'O': (2,), 'F': (1,), 'Ne': (0,), 'Si': (4,),
+             'P': (3, 5), 'S': (2, 4, 6), 'Cl': (1,), 'Ar': (0,), 'Ge': (4,), 'As': (3, 5), 'Se': (2, 4, 6),
+             'Br': (1,), 'Kr': (0,), 'Te': (2, 4, 6), 'I': (1, 3, 5), 'Xe': (0,)}
+
+#: Molfile atom block charge codes
+_MOLFILE_CHARGES = {0: 0, 1: 3, 2: 2, 3: 1, 4: 0, 5: -1, 6: -2, 7: -3}
+
+
+class ConnectionTable(object):
+    """Compact array-backed connection table of atoms and bonds, parsed from a V2000 molfile or SDF record.
+
+    Descriptors are computed from the connection table without contacting CIR. Hydrogens that are not explicit atoms
+    are added according to the default valences of each element, which requires Kekulé rather than aromatic bonds.
+    """
+
+    def __init__(self, atoms, charges, masses, begin, end, orders):
+        """
+
+        :param array atoms: Atomic number of each atom
+        :param array charges: Formal charge of each atom
+        :param array masses: Isotope mass number of each atom, or 0 for natural abundance
+        :param array begin: Index of the first atom of each bond
+        :param array end: Index of the second atom of each bond
+        :param array orders: Order of each bond, with 4 for aromatic
+        """
+        self.atoms = atoms
+        self.charges = charges
+        self.masses = masses
+        self.begin = begin
+        self.end = end
+        self.orders = orders
+        self._neighbors = None
+        self._hydrogens = None
+        self._implicit = None
+        self._ring_bonds = None
+
+    @classmethod
+    def from_molfile(cls, molfile):
+        """Parse the first record of a V2000 molfile or SDF.
+
+        :param string molfile: Molfile or SDF text
+        :rtype: ConnectionTable
+        :raises ValueError: if the connection table cannot be parsed or contains unknown elements
+        """
+        lines = molfile.splitlines()
+        if len(lines) < 4 or 'V3000' in lines[3]:
+            raise ValueError('Only V2000 molfiles are supported')
+        num_atoms, num_bonds = int(lines[3][0:3]), int(lines[3][3:6])
+        atoms, charges, masses = array.array('B'), array.array('b'), array.array('H')
+        for line in lines[4:4 + num_atoms]:
+            symbol = line[31:34].strip()
+            if symbol not in _ATOMIC_NUMBERS:
+                raise ValueError('Unknown element: %s' % symbol)
+            atoms.append(_ATOMIC_NUMBERS[symbol])
+            charges.append(_MOLFILE_CHARGES.get(int(line[36:39] or 0), 0))
+            masses.append(0)
+        begin, end, orders = array.array('H'), array.array('H'), array.array('B')
+        for line in lines[4 + num_atoms:4 + num_atoms + num_bonds]:
+            begin.append(int(line[0:3]) - 1)
+            end.append(int(line[3:6]) - 1)
+            orders.append(int(line[6:9]))
+            if not 1 <= orders[-1] <= 4:
+                raise ValueError('Unsupported bond type: %s' % orders[-1])
+        if len(atoms) != num_atoms or len(orders) != num_bonds:
+            raise ValueError('Truncated connection table')
+        charged = False
+        for line in lines[4 + num_atoms + num_bonds:]:
+            if line.startswith('M  END'):
+                break
+            if line.startswith('M  CHG') or line.startswith('M  ISO'):
+                # Charges in the properties block replace all charges in the atom block
+                if line.startswith('M  CHG') and not charged:
+                    charges = array.array('b', [0] * num_atoms)
+                    charged = True
+                values = [int(value) for value in line[9:].split()]
+                target = charges if line.startswith('M  CHG') else masses
+                for atom, value in zip(values[0::2], values[1::2]):
+                    target[atom - 1] = value
+        return cls(atoms, charges, masses, begin, end, orders)
+
+    def neighbors(self):
+        """Return a list of ``(atom index, bond index)`` neighbor pairs for each atom."""
+        if self._neighbors is None:
+            neighbors = [[] for _ in self.atoms]
+            for bond, (a, b) in enumerate(zip(self.begin, self.end)):
+                neighbors[a].append((b, bond))
+                neighbors[b].append((a, bond))
+            self._neighbors = neighbors
+        return self._neighbors
+
+    def hydrogens(self):
+        """Return the total number of explicit and implicit hydrogens on each atom.
+
+        :raises ValueError: if implicit hydrogens must be inferred for an atom with aromatic bonds, or there are no
+                            heavy atoms
+        """
+        if self._hydrogens is None:
+            if all(number == 1 for number in self.atoms):
+                raise ValueError('No heavy atoms')
+            hydrogens, implicit_counts = [], []
+            for atom, (number, charge) in enumerate(zip(self.atoms, self.charges)):
+                neighbors = self.neighbors()[atom]
+                explicit = sum(1 for other, _ in neighbors if self.atoms[other] == 1)
+                valences = None
+                if number != 1 and 0 < number - charge <= len(ELEMENTS):
+                    valences = _VALENCES.get(ELEMENTS[number - charge - 1][0])
+                implicit = 0
+                if valences is not None:
+                    if any(self.orders[bond] > 3 for _, bond in neighbors):
+                        # Aromatic bonds don't say how many hydrogens each atom has, e.g. in pyrrole
+                        raise ValueError('Cannot infer hydrogens for an atom with aromatic bonds')
+                    bond_sum = sum(self.orders[bond] for _, bond in neighbors)
+                    valence = next((v for v in valences if v >= bond_sum), bond_sum)
+                    implicit = valence - bond_sum
+                hydrogens.append(explicit + implicit)
+                implicit_counts.append(implicit)
+            self._hydrogens, self._implicit = hydrogens, implicit_counts
+        return self._hydrogens
+
+    def _implicit_hydrogens(self):
+        """Return the number of hydrogens that are not explicit atoms."""
+        self.hydrogens()
+        return sum(self._implicit)
+
+    def ring_bonds(self):
+        """Return the set of indices of bonds that are part of a ring."""
+        if self._ring_bonds is None:
+            neighbors = self.neighbors()
+            order, low, bridges = [-1] * len(self.atoms), [0] * len(self.atoms), set()
+            counter = 0
+            for root in range(len(self.atoms)):
+                if order[root] >= 0:
+                    continue
+                order[root] = low[root] = counter
+                counter += 1
+                stack = [(root, -1, iter(neighbors[root]))]
+                while stack:
+                    atom, parent_bond, remaining = stack[-1]
+                    for other, bond in remaining:
+                        if bond == parent_bond:
+                            continue
+                        if order[other] < 0:
+                            order[other] = low[other] = counter
+                            counter += 1
+                            stack.append((other, bond, iter(neighbors[other])))
+                            break
+                        low[atom] = min(low[atom], order[other])
+                    else:
+                        stack.pop()
+                        if stack:
+                            parent = stack[-1][0]
+                            low[parent] = min(low[parent], low[atom])
+                            if low[atom] > order[parent]:
+                                bridges.add(parent_bond)
+            self._ring_bonds = set(range(len(self.orders))) - bridges
+        return self._ring_bonds
+
+    def _components(self, bonds):
+        """Return a list with the index of the connected component that each atom belongs to, joined by bonds."""
+        parents = list(range(len(self.atoms)))
+
+        def find(atom):
+            while parents[atom] != atom:
+                parents[atom] = parents[parents[atom]]
+                atom = parents[atom]
+            return atom
+        for bond in bonds:
+            parents[find(self.begin[bond])] = find(self.end[bond])
+        return [find(atom) for atom in range(len(self.atoms))]
+
+    def formula(self):
+        """Molecular formula in Hill order."""
+        counts = collections.Counter(ELEMENTS[number - 1][0] for number in self.atoms if number != 1)
+        hydrogens = sum(1 for number in self.atoms if number == 1) + self._implicit_hydrogens()
+        if hydrogens:
+            counts['H'] = hydrogens
+        if 'C' in counts:
+            symbols = ['C'] + (['H'] if 'H' in counts else []) + sorted(s for s in counts if s not in ('C', 'H'))
+        else:
+            symbols = sorted(counts)
+        return ''.join('%s%s' % (symbol, counts[symbol] if counts[symbol] > 1 else '') for symbol in symbols)
+
+    def mw(self):
+        """Molecular weight, using standard atomic weights or the isotope mass number where specified."""
+        weight = sum(mass or ELEMENTS[number - 1][1] for number, mass in zip(self.atoms, self.masses))
+        return weight + self._implicit_hydrogens() * ELEMENTS[0][1]
+
+    def ring_count(self):
+        """Number of rings in the smallest set of smallest rings."""
+        return len(self.orders) - len(self.atoms) + len(set(self._components(range(len(self.orders)))))
+
+    def ringsys_count(self):
+        """Number of ring systems, where rings that share an atom are in the same system."""
+        ring_bonds = self.ring_bonds()
+        components = self._components(ring_bonds)
+        return len(set(components[self.begin[bond]] for bond in ring_bonds))
+
+    def rotor_count(self):
+        """Number of rotatable bonds: single, non-ring bonds between non-terminal heavy atoms not in a triple bond."""
+        neighbors, ring_bonds = self.neighbors(), self.ring_bonds()
+        heavy_degree = [sum(1 for other, _ in n if self.atoms[other] != 1) for n in neighbors]
+        triple = set(atom for bond, order in enumerate(self.orders) if order == 3
+                     for atom in (self.begin[bond], self.end[bond]))
+        return sum(1 for bond, (a, b, order) in enumerate(zip(self.begin, self.end, self.orders))
+                   if order == 1 and bond not in ring_bonds and self.atoms[a] != 1 and self.atoms[b] != 1 and
+                   heavy_degree[a] > 1 and heavy_degree[b] > 1 and a not in triple and b not in triple)
+
+    def h_bond_donor_count(self):
+        """Number of nitrogen and oxygen atoms with at least one hydrogen."""
+        return sum(1 for number, h in zip(self.atoms, self.hydrogens()) if number in (7, 8) and h > 0)
+
+    def descriptors(self):
+        """Return a dict of all descriptors, formatted as strings in the same way as CIR.
+
+        :raises ValueError: if hydrogens cannot be inferred, see :meth:`hydrogens`
+        """
+        return {
+            'formula': self.formula(),
+            'mw': '%.4f' % self.mw(),
+            'ring_count': str(self.ring_count()),
+            'ringsys_count': str(self.ringsys_count()),
+            'rotor_count': str(self.rotor_count()),
+            'h_bond_donor_count': str(self.h_bond_donor_count()),
+        }
+
+
+#: Molecule properties that can be computed locally from the SDF connection table
+LOCAL_DESCRIPTORS = {'formula', 'mw', 'ring_count', 'ringsys_count', 'rotor_count', 'h_bond_donor_count'}
+
+_local_descriptors = False
+
+
+def enable_local_descriptors():
+    """Compute :data:`LOCAL_DESCRIPTORS` properties of :class:`Molecule` locally from its SDF.
+
+    The SDF is requested once and parsed into a :class:`ConnectionTable`, instead of making a separate request for each
+    property. Values are computed with common definitions, so they may differ slightly from those CIR would return,
+    for example in the last decimal places of the molecular weight. If the SDF cannot be parsed, the property is
+    requested from CIR as usual.
+    """
+    global _local_descriptors
+    _local_descriptors = True
+
+
+def disable_local_descriptors():
+    """Request all :class:`Molecule` properties from CIR."""
+    global _local_descriptors
+    _local_descriptors = False
+
+
+def structure_property(fget):
+    """Decorator to create memoized properties that are shared by Molecules with the same structure.
+
+    The value is shared through the identity index when it is enabled, see :func:`enable_identity_index`.
+    """
+    @functools.wraps(fget)
+    def fget_shared(self):
+        index = _identity_index
+        if index is None or self.kwargs:
+            return fget(self)
+        return index.get(self, fget.__name__, fget)
+    return memoized_property(fget_shared)
+
+
 class Molecule(object):
     """Class to hold and cache the structure information for a given CIR input."""
 
@@ -313,12 +2787,12 @@ class Molecule(object):
         return 'Molecule(input=%r, resolvers=%r, get3d=%r, kwargs=%r)' \
                % (self.input, self.resolvers, self.get3d, self.kwargs)
 
-    @memoized_property
+    @structure_property
     def stdinchi(self):
         """Standard InChI."""
         return resolve(self.input, 'stdinchi', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def stdinchikey(self):
         """Standard InChIKey."""
         return resolve(self.input, 'stdinchikey', self.resolvers, **self.kwargs)
@@ -328,7 +2802,7 @@ class Molecule(object):
         """Non-standard InChI. (Uses options DONOTADDH W0 FIXEDH RECMET NEWPS SPXYZ SAsXYZ Fb Fnud)."""
         return resolve(self.input, 'inchi', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def smiles(self):
         """SMILES string."""
         return resolve(self.input, 'smiles', self.resolvers, **self.kwargs)
@@ -373,61 +2847,108 @@ class Molecule(object):
         """CAS registry numbers."""
         return resolve(self.input, 'cas', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def mw(self):
         """Molecular weight."""
-        return resolve(self.input, 'mw', self.resolvers, **self.kwargs)
+        return self._descriptor('mw')
 
-    @memoized_property
+    @structure_property
     def formula(self):
         """Molecular formula"""
-        return resolve(self.input, 'formula', self.resolvers, **self.kwargs)
+        return self._descriptor('formula')
 
-    @memoized_property
+    @structure_property
     def h_bond_donor_count(self):
         """Hydrogen bond donor count."""
-        return resolve(self.input, 'h_bond_donor_count', self.resolvers, **self.kwargs)
+        return self._descriptor('h_bond_donor_count')
 
-    @memoized_property
+    @structure_property
     def h_bond_acceptor_count(self):
         """Hydrogen bond acceptor count."""
         return resolve(self.input, 'h_bond_acceptor_count', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def h_bond_center_count(self):
         """Hydrogen bond center count."""
         return resolve(self.input, 'h_bond_center_count', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def rule_of_5_violation_count(self):
         """Rule of 5 violation count."""
         return resolve(self.input, 'rule_of_5_violation_count', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def rotor_count(self):
         """Rotor count."""
-        return resolve(self.input, 'rotor_count', self.resolvers, **self.kwargs)
+        return self._descriptor('rotor_count')
 
-    @memoized_property
+    @structure_property
     def effective_rotor_count(self):
         """Effective rotor count."""
         return resolve(self.input, 'effective_rotor_count', self.resolvers, **self.kwargs)
 
-    @memoized_property
+    @structure_property
     def ring_count(self):
         """Ring count."""
-        return resolve(self.input, 'ring_count', self.resolvers, **self.kwargs)
+        return self._descriptor('ring_count')
 
-    @memoized_property
+    @structure_property
     def ringsys_count(self):
         """Ring system count."""
-        return resolve(self.input, 'ringsys_count', self.resolvers, **self.kwargs)
+        return self._descriptor('ringsys_count')
 
     @memoized_property
     def image(self):
         """2D image depiction."""
         return resolve_image(self.input, self.resolvers, **self.kwargs)
 
+    def _descriptor(self, representation):
+        """Return a property computed from the SDF if local descriptors are enabled, otherwise resolve it from CIR."""
+        if _local_descriptors:
+            sdf = self.sdf
+            if sdf is None:
+                return None
+            # All descriptors are computed together once, and an empty dict records that they can't be computed
+            if getattr(self, '_local_descriptors', None) is None:
+                try:
+                    self._local_descriptors = ConnectionTable.from_molfile(sdf).descriptors()
+                except ValueError as e:
+                    log.debug('Cannot compute descriptors locally: %s', e)
+                    self._local_descriptors = {}
+            if representation in self._local_descriptors:
+                return self._local_descriptors[representation]
+        return resolve(self.input, representation, self.resolvers, **self.kwargs)
+
+    @classmethod
+    def memoized_properties(cls):
+        """Return the names of all memoized properties, each of which requires a request to CIR."""
+        return [name for name in dir(cls) if hasattr(getattr(getattr(cls, name), 'fget', None), 'memoized_attr')]
+
+    def prefetch(self, properties, max_workers=4):
+        """Resolve several properties concurrently and cache them on this Molecule.
+
+        Properties that are already cached are skipped. Errors are logged and the property is left unresolved, so
+        that accessing it later raises the error as usual.
+
+        :param list(string) properties: Names of memoized properties, e.g. ['smiles', 'stdinchikey', 'mw']
+        :param int max_workers: (Optional) Maximum number of simultaneous requests
+        :raises AttributeError: if a name is not a memoized property
+        """
+        memoized = self.memoized_properties()
+        for prop in properties:
+            if prop not in memoized:
+                raise AttributeError('%r is not a memoized Molecule property' % prop)
+        pending = [prop for prop in properties if not hasattr(self, '_%s' % prop)]
+        for _ in _imap(_capture_errors(lambda prop: getattr(self, prop)), pending, max_workers):
+            pass
+
+    def prefetch_all(self, max_workers=4):
+        """Resolve all memoized properties concurrently and cache them on this Molecule.
+
+        :param int max_workers: (Optional) Maximum number of simultaneous requests
+        """
+        self.prefetch(self.memoized_properties(), max_workers)
+
     @property
     def image_url(self):
         """URL of a GIF image."""
@@ -438,6 +2959,18 @@ class Molecule(object):
         """Url of a TwirlyMol 3D viewer."""
         return construct_api_url(self.input, 'twirl', self.resolvers, False, self.get3d, False, **self.kwargs)
 
+    def image_file(self, directory, **kwargs):
+        """Save a 2D image depiction in a content-addressed directory, and return its path instead of the image data.
+
+        Accepts the same rendering options as :func:`resolve_image`. See :class:`ImageStore`.
+
+        :param string directory: Directory to store images in, which is created if necessary
+        :returns: File path, or None if nothing resolved
+        :rtype: string or None
+        """
+        kwargs = dict(self.kwargs, **kwargs)
+        return ImageStore(directory).get(self.input, self.resolvers, **kwargs)
+
     def download(self, filename, representation, overwrite=False):
         """Download the resolved structure as a file.
 
@@ -446,3 +2979,175 @@ class Molecule(object):
         :param bool overwrite: (Optional) Whether to allow overwriting of an existing file
         """
         download(self.input, filename, representation, overwrite, self.resolvers, self.get3d, **self.kwargs)
+
+    def resolved_properties(self):
+        """Return a dict of the memoized properties that have already been resolved, without making any requests."""
+        return dict((prop, getattr(self, '_%s' % prop)) for prop in self.memoized_properties()
+                    if hasattr(self, '_%s' % prop))
+
+    def to_dict(self):
+        """Return a dict of the input parameters and resolved properties, from which the Molecule can be recreated."""
+        return {'input': self.input, 'resolvers': self.resolvers, 'get3d': self.get3d, 'kwargs': self.kwargs,
+                'properties': self.resolved_properties()}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create a Molecule from a dict returned by :meth:`to_dict`, with its properties already resolved."""
+        molecule = cls(d['input'], d.get('resolvers'), d.get('get3d', False), **d.get('kwargs', {}))
+        memoized = cls.memoized_properties()
+        for prop, value in d.get('properties', {}).items():
+            if prop in memoized:
+                setattr(molecule, '_%s' % prop, value)
+        return molecule
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__dict__.update(self.from_dict(state).__dict__)
+
+
+class MoleculeStore(object):
+    """Compact file of Molecules and their resolved properties, for saving and restoring a working set in bulk.
+
+    Molecules are stored as gzip-compressed JSON Lines, one per line, with binary properties such as images encoded as
+    base64. Only properties that have already been resolved are saved, and loading makes no requests to CIR.
+    """
+
+    def __init__(self, path):
+        """
+
+        :param string path: Path of the store file
+        """
+        self.path = path
+
+    def save(self, molecules):
+        """Save Molecules to the store, replacing its contents. The file is replaced atomically once complete.
+
+        :param molecules: Molecules to save
+        :type molecules: iterable(Molecule)
+        :returns: Number of Molecules saved
+        :rtype: int
+        """
+        fd, temp_path = _temp_file(self.path)
+        count = 0
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                for molecule in molecules:
+                    record = molecule.to_dict()
+                    binary = [prop for prop, value in record['properties'].items() if isinstance(value, bytes)]
+                    for prop in binary:
+                        record['properties'][prop] = base64.b64encode(record['properties'][prop]).decode('ascii')
+                    if binary:
+                        record['binary'] = binary
+                    f.write((json.dumps(record) + '\n').encode('utf-8'))
+                    count += 1
+            getattr(os, 'replace', os.rename)(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return count
+
+    def __iter__(self):
+        """Iterate over the Molecules in the store, reading one at a time."""
+        with gzip.GzipFile(self.path, 'rb') as f:
+            for line in f:
+                record = json.loads(line.decode('utf-8'))
+                for prop in record.pop('binary', []):
+                    record['properties'][prop] = base64.b64decode(record['properties'][prop])
+                yield Molecule.from_dict(record)
+
+    def load(self):
+        """Return a list of all Molecules in the store.
+
+        :rtype: list(Molecule)
+        """
+        return list(self)
+
+
+def _format_tsv_field(value):
+    """Return a value as a single TSV field, with list items separated by | and tabs and newlines escaped."""
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = '|'.join(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def main(argv=None):
+    """Command line tool that resolves identifiers read line by line and streams the results to stdout.
+
+    Identifiers are resolved concurrently by a pool of worker threads, but results are written in input order as
+    JSON Lines or TSV. Only a bounded number of lines are held in memory at once, so arbitrarily large inputs can be
+    processed in a Unix pipeline. Errors for individual lines are written to stderr, and recorded in the JSON Lines
+    output, without stopping the remaining lines.
+
+    :returns: Exit status, which is 1 if any line could not be resolved
+    :rtype: int
+    """
+    global _cache, _retry_policy
+    import argparse
+    parser = argparse.ArgumentParser(prog='cirpy', description='Resolve chemical identifiers using CIR.')
+    parser.add_argument('input', nargs='?', default='-', help='file with one identifier per line (default stdin)')
+    parser.add_argument('-r', '--representation', action='append', dest='representations',
+                        help='output representation, may be given multiple times (default smiles)')
+    parser.add_argument('--resolvers', help='comma-separated ordered list of resolvers to use')
+    parser.add_argument('--get3d', action='store_true', help='return 3D coordinates where applicable')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'tsv'], default='jsonl', help='output format')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='maximum number of simultaneous requests')
+    parser.add_argument('--cache', metavar='PATH', help='cache responses in a SQLite database')
+    parser.add_argument('--retries', type=int, default=0, help='number of times to retry failed requests')
+    args = parser.parse_args(argv)
+    representations = args.representations or ['smiles']
+    resolvers = args.resolvers.split(',') if args.resolvers else None
+    # Restore any cache or retry policy the caller had configured on exit, rather than disabling them
+    previous_cache, previous_retry_policy = _cache, _retry_policy
+    if args.cache:
+        _cache = ResponseCache(args.cache)
+    if args.retries:
+        _retry_policy = RetryPolicy(max_attempts=args.retries + 1)
+
+    def resolve_line(input):
+        values, errors = [], {}
+        for representation in representations:
+            try:
+                value = resolve(input, representation, resolvers, args.get3d)
+            except (IOError, OSError, http_client.HTTPException, etree.ParseError, CircuitOpenError) as e:
+                errors[representation] = str(e) or e.__class__.__name__
+                value = None
+            values.append(value)
+        return input, values, errors
+
+    status = 0
+    f = sys.stdin if args.input == '-' else io.open(args.input, encoding='utf-8')
+    try:
+        inputs = (line.strip() for line in f if line.strip())
+        if args.format == 'tsv':
+            sys.stdout.write('\t'.join(['input'] + representations) + '\n')
+        for input, values, errors in _imap(resolve_line, inputs, args.workers):
+            for representation in representations:
+                if representation in errors:
+                    sys.stderr.write('cirpy: %s: %s: %s\n' % (input, representation, errors[representation]))
+                    status = 1
+            if args.format == 'tsv':
+                sys.stdout.write('\t'.join(_format_tsv_field(value) for value in [input] + values) + '\n')
+            else:
+                record = collections.OrderedDict([('input', input)] + list(zip(representations, values)))
+                if errors:
+                    record['errors'] = errors
+                sys.stdout.write(json.dumps(record) + '\n')
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        sys.stdout.flush()
+        if args.cache:
+            _cache.close()
+            _cache = previous_cache
+        if args.retries:
+            _retry_policy = previous_retry_policy
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
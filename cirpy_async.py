@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+CIRpy asyncio client
+
+Coroutine equivalents of the CIRpy request functions, built on non-blocking asyncio streams. Requires Python 3.5+.
+https://github.com/mcs07/CIRpy
+"""
+
+import asyncio
+import email.parser
+import http.client
+import inspect
+import io
+import os
+import ssl
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+import cirpy
+from cirpy import log
+
+
+class AsyncResponse(object):
+    """A complete HTTP response read from an asyncio stream."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class AsyncConnectionPool(object):
+    """Pool of persistent keep-alive connections for use from a single event loop.
+
+    A semaphore limits the number of requests in flight, which provides backpressure when thousands of lookups are
+    scheduled at once.
+    """
+
+    #: HTTP status codes that are followed as redirects
+    redirect_codes = {301, 302, 303, 307, 308}
+
+    def __init__(self, max_concurrency=20, idle_timeout=60, timeout=30, compress=True):
+        """
+
+        :param int max_concurrency: (Optional) Maximum number of requests in flight at once
+        :param float idle_timeout: (Optional) Seconds after which an unused connection is discarded
+        :param float timeout: (Optional) Timeout in seconds for each request
+        :param bool compress: (Optional) Whether to request gzip or deflate compressed responses
+        """
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.compress = compress
+        self._loop = None
+        self._semaphore = None
+        self._idle = {}
+
+    def _bind(self):
+        """Reset loop-bound state if the pool is used from a different event loop."""
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._idle = {}
+
+    async def _connect(self, key):
+        """Return a ``(reader, writer, reused)`` tuple for the given ``(scheme, host, port)`` key."""
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if self._loop.time() - last_used < self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer, reuse):
+        if reuse:
+            self._idle.setdefault(key, []).append((reader, writer, self._loop.time()))
+        else:
+            writer.close()
+
+    async def _send(self, reader, writer, host, path, headers):
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % host, 'Connection: keep-alive']
+        lines.extend('%s: %s' % header for header in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by server')
+        return status_line
+
+    async def _read(self, reader, url, status_line):
+        """Read the remainder of a response. Returns the response and whether the connection can be reused."""
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line.decode('latin-1'))
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(''.join(header_lines))
+        reuse = headers.get('Connection', '').lower() != 'close'
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'Content-Length' in headers:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            reuse = False
+        body = cirpy._decode_body(body, headers.get('Content-Encoding'))
+        return AsyncResponse(url, int(status), reason, headers, body), reuse
+
+    async def _urlopen(self, url, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = '%s?%s' % (parts.path, parts.query) if parts.query else parts.path
+        while True:
+            reader, writer, reused = await self._connect(key)
+            try:
+                status_line = await self._send(reader, writer, parts.netloc, path, headers)
+                break
+            except (OSError, asyncio.IncompleteReadError):
+                writer.close()
+                # The server may have dropped an idle keep-alive connection, so retry on a fresh one
+                if not reused:
+                    raise
+                log.debug('Stale pooled connection to %s, reconnecting', key[1])
+            except BaseException:
+                writer.close()
+                raise
+        try:
+            response, reuse = await self._read(reader, url, status_line)
+        except BaseException:
+            writer.close()
+            raise
+        self._release(key, reader, writer, reuse)
+        return response
+
+    async def urlopen(self, url, headers=None, redirects=5):
+        """Make a GET request and return the complete response.
+
+        :param string url: URL to request
+        :param dict headers: (Optional) Additional request headers
+        :param int redirects: (Optional) Maximum number of redirects to follow
+        :rtype: AsyncResponse
+        :raises HTTPError: if the server returns an error code, or a redirect without a location
+        """
+        self._bind()
+        request_headers = dict(headers or {})
+        if self.compress:
+            request_headers.setdefault('Accept-Encoding', cirpy.ACCEPT_ENCODING)
+        async with self._semaphore:
+            response = await asyncio.wait_for(self._urlopen(url, request_headers), self.timeout)
+        if response.status in self.redirect_codes:
+            location = response.headers.get('Location')
+            if location is None or redirects <= 0:
+                reason = 'Redirect without a Location header' if location is None else 'Too many redirects'
+                raise HTTPError(url, response.status, reason, response.headers, io.BytesIO(response.body))
+            return await self.urlopen(urljoin(url, location), headers, redirects - 1)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(response.body))
+        return response
+
+    def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer, _ in connections:
+                writer.close()
+
+
+_pool = AsyncConnectionPool()
+
+
+def configure_pool(max_concurrency=20, idle_timeout=60, timeout=30, compress=True):
+    """Replace the shared asyncio connection pool.
+
+    :param int max_concurrency: (Optional) Maximum number of requests in flight at once
+    :param float idle_timeout: (Optional) Seconds after which an unused connection is discarded
+    :param float timeout: (Optional) Timeout in seconds for each request
+    :param bool compress: (Optional) Whether to request gzip or deflate compressed responses
+    """
+    global _pool
+    old_pool, _pool = _pool, AsyncConnectionPool(max_concurrency, idle_timeout, timeout, compress)
+    old_pool.close()
+
+
+async def arequest(input, representation, resolvers=None, get3d=False, tautomers=False, **kwargs):
+    """Make a request to CIR and return the XML response. Coroutine equivalent of :func:`cirpy.request`.
+
+    :param string input: Chemical identifier to resolve
+    :param string representation: Desired output representation
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :param bool tautomers: (Optional) Whether to return all tautomers
+    :returns: XML response from CIR
+    :rtype: Element
+    :raises HTTPError: if CIR returns an error code
+    :raises ParseError: if CIR response is uninterpretable
+    """
+    url = cirpy.construct_api_url(input, representation, resolvers, get3d, tautomers, **kwargs)
+    log.debug('Making async request: %s', url)
+    response = await _pool.urlopen(url)
+    return cirpy.etree.fromstring(response.body)
+
+
+async def aquery(input, representation, resolvers=None, get3d=False, tautomers=False, **kwargs):
+    """Get all results for resolving input to the specified output representation. Coroutine equivalent of
+    :func:`cirpy.query`.
+
+    :param string input: Chemical identifier to resolve
+    :param string representation: Desired output representation
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :param bool tautomers: (Optional) Whether to return all tautomers
+    :returns: List of resolved results
+    :rtype: list(Result)
+    :raises HTTPError: if CIR returns an error code
+    :raises ParseError: if CIR response is uninterpretable
+    """
+    url = cirpy.construct_api_url(input, representation, resolvers, get3d, tautomers, **kwargs)
+    log.debug('Making async request: %s', url)
+    response = await _pool.urlopen(url)
+    return list(cirpy._iter_results(response.body))
+
+
+async def aresolve(input, representation, resolvers=None, get3d=False, **kwargs):
+    """Resolve input to the specified output representation. Coroutine equivalent of :func:`cirpy.resolve`.
+
+    :param string input: Chemical identifier to resolve
+    :param string representation: Desired output representation
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :returns: Output representation or None
+    :rtype: string or None
+    :raises HTTPError: if CIR returns an error code
+    :raises ParseError: if CIR response is uninterpretable
+    """
+    results = await aquery(input, representation, resolvers, get3d, **kwargs)
+    return results[0].value if results else None
+
+
+async def aresolve_image(input, resolvers=None, **kwargs):
+    """Resolve input to a 2D image depiction. Coroutine equivalent of :func:`cirpy.resolve_image`.
+
+    Accepts the same rendering options as :func:`cirpy.resolve_image`, with the same defaults.
+
+    :param string input: Chemical identifier to resolve
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :returns: Image data
+    :rtype: bytes
+    """
+    bound = inspect.signature(cirpy.resolve_image).bind(input, resolvers, **kwargs)
+    bound.apply_defaults()
+    args = {k: v for k, v in bound.arguments.items() if k != 'kwargs' and v is not None}
+    args.update(bound.arguments['kwargs'])
+    url = cirpy._image_url(args)
+    log.debug('Making async image request: %s', url)
+    response = await _pool.urlopen(url)
+    return response.body
+
+
+async def adownload(input, filename, representation, overwrite=False, resolvers=None, get3d=False, **kwargs):
+    """Save a CIR response as a file. Coroutine equivalent of :func:`cirpy.download`.
+
+    :param string input: Chemical identifier to resolve
+    :param string filename: File path to save to
+    :param string representation: Desired output representation
+    :param bool overwrite: (Optional) Whether to allow overwriting of an existing file
+    :param list(string) resolvers: (Optional) Ordered list of resolvers to use
+    :param bool get3d: (Optional) Whether to return 3D coordinates (where applicable)
+    :raises HTTPError: if CIR returns an error code
+    :raises ParseError: if CIR response is uninterpretable
+    :raises IOError: if overwrite is False and file already exists
+    """
+    result = await aresolve(input, representation, resolvers, get3d, **kwargs)
+    # Just log and return if nothing resolved
+    if not result:
+        log.debug('No file to download.')
+        return
+    # Only overwrite an existing file if explicitly instructed to.
+    if not overwrite and os.path.isfile(filename):
+        raise IOError("%s already exists. Use 'overwrite=True' to overwrite it." % filename)
+    # Ensure file ends with a newline
+    if not result.endswith('\n'):
+        result += '\n'
+    with open(filename, 'w') as f:
+        f.write(result)
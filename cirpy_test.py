@@ -9,15 +9,32 @@ https://github.com/mcs07/CIRpy
 from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
+import errno
 import logging
+import io
+import json
 import os
+import pickle
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
 
 try:
-    from urllib.error import HTTPError
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import unquote
 except ImportError:
-    from urllib2 import HTTPError
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urllib2 import HTTPError, URLError
 
 try:
     from lxml import etree
@@ -27,6 +44,13 @@ except ImportError:
     except ImportError:
         import xml.etree.ElementTree as etree
 
+try:
+    import asyncio
+    import cirpy_async
+except (ImportError, SyntaxError):
+    cirpy_async = None
+
+import cirpy
 from cirpy import request, resolve, query, Molecule, Result, resolve_image
 
 
@@ -40,6 +64,1170 @@ class RateLimitTestCase(unittest.TestCase):
         time.sleep(float(os.environ.get('CIRPY_TEST_DELAY', 0)))
 
 
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for CIR that answers /structure/<input>/<representation>[/xml] with keep-alive."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    paths = []
+    molfiles = {}
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        StubHandler.connections += 1
+
+    def do_GET(self):
+        StubHandler.paths.append(self.path)
+        # Requests forwarded by a proxy have the absolute URL as their path
+        parts = self.path.split('?')[0].split('/')[(3 if self.path.startswith('http://') else 0):]
+        parts = [''] + parts if self.path.startswith('http://') else parts
+        input, representation = unquote(parts[3]), parts[4]
+        xml = parts[-1] == 'xml'
+        if input.startswith('slow'):
+            time.sleep(0.2)
+        if input.startswith('stall') and StubHandler.paths.count(self.path) == 1:
+            time.sleep(1)
+        if input.startswith('flaky') and StubHandler.paths.count(self.path) < 3:
+            return self.respond(500, b'Internal Server Error', 'text/html')
+        if 'busy' in input:
+            return self.respond(503, b'Service Unavailable', 'text/html')
+        if 'nolocation' in input:
+            return self.respond(302, b'Found', 'text/html')
+        if 'missing' in input:
+            return self.respond(404, b'Page not found (404)', 'text/html')
+        if input.startswith('empty') and not xml:
+            return self.respond(404, b'Page not found (404)', 'text/html')
+        if input.startswith('empty'):
+            return self.respond(200, ('<request string="%s" representation="%s"></request>' % (input, representation)).encode('utf-8'), 'text/xml')
+        if representation == 'sdf' and input in StubHandler.molfiles:
+            return self.respond(200, StubHandler.molfiles[input].encode('utf-8'), 'text/plain')
+        value = '%s-%s' % (representation, input)
+        if representation == 'stdinchikey':
+            # Inputs that differ only after ~ are aliases of the same structure
+            value = '%s-%s' % (representation, input.split('~')[0])
+        items = [value, '%s-2' % value] if representation == 'names' else [value]
+        if xml:
+            count = int(input[5:]) if input.startswith('multi') else 1
+            data = ''.join('<data id="%s" resolver="stub" string_class="stub class" notation="%s">%s</data>' % (
+                i + 1, input, ''.join('<item id="%s">%s</item>' % (j + 1, item if i == 0 else '%s-%s' % (item, i))
+                                      for j, item in enumerate(items))) for i in range(count))
+            body = '<request string="%s" representation="%s">%s</request>' % (input, representation, data)
+            return self.respond(200, body.encode('utf-8'), 'text/xml')
+        if input.startswith('multi'):
+            # One line for each match, like CIR
+            items = [value] + ['%s-%s' % (value, i) for i in range(1, int(input[5:]))]
+        self.respond(200, '\n'.join(items).encode('utf-8'), 'text/plain')
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        accept = self.headers.get('Accept-Encoding', '')
+        # Error responses are only compressed for inputs that ask for it
+        compress = status == 200 or 'compressed' in self.path
+        if compress and 'deflate' in accept and 'deflate' in self.path:
+            # Raw deflate stream without a zlib header, as sent by some servers
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'deflate')
+        elif compress and 'gzip' in accept:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients close connections of cancelled requests before the response is written
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class StubTestCase(unittest.TestCase):
+    """TestCase that points cirpy at a local CIR stand-in server instead of the live service."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer(('127.0.0.1', 0), StubHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.api_base = cirpy.API_BASE
+        cirpy.API_BASE = 'http://127.0.0.1:%s/chemical/structure' % self.server.server_address[1]
+        cirpy.configure_pool()
+        StubHandler.connections = 0
+        StubHandler.paths = []
+
+    def tearDown(self):
+        cirpy.API_BASE = self.api_base
+        cirpy.configure_pool()
+
+
+class TestConnectionPool(StubTestCase):
+    """Test that requests share persistent connections from the pool."""
+
+    def test_connection_reuse(self):
+        """Test that consecutive queries reuse a single keep-alive connection."""
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(resolve('Aspirin', 'stdinchikey'), 'stdinchikey-Aspirin')
+        self.assertEqual(resolve_image('Aspirin'), b'image-Aspirin')
+        self.assertEqual(StubHandler.connections, 1)
+
+    def test_error_response(self):
+        """Test that HTTPError is raised for error codes and the pool remains usable."""
+        with self.assertRaises(HTTPError):
+            request('missing', 'smiles')
+        self.assertEqual(len(request('empty', 'smiles')), 0)
+
+    def test_redirect_without_location(self):
+        """Test that a redirect without a Location header raises HTTPError."""
+        with self.assertRaises(HTTPError) as context:
+            resolve('nolocation', 'smiles')
+        self.assertEqual(context.exception.code, 302)
+
+    def test_connection_error(self):
+        """Test that connection failures raise URLError, like urllib."""
+        cirpy.API_BASE = 'http://127.0.0.1:1/chemical/structure'
+        with self.assertRaises(URLError):
+            resolve('Aspirin', 'smiles')
+
+    def test_proxy(self):
+        """Test that requests go through urllib when a proxy is configured in the environment."""
+        environ = dict(os.environ)
+        os.environ['http_proxy'] = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        cirpy.API_BASE = 'http://cir.invalid/chemical/structure'
+        try:
+            self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        self.assertEqual(StubHandler.paths, ['http://cir.invalid/chemical/structure/Aspirin/smiles'])
+
+    def test_per_host_limit(self):
+        """Test that the per-host limit caps the number of simultaneous connections."""
+        cirpy.configure_pool(per_host=2)
+        threads = [threading.Thread(target=resolve, args=('Aspirin%s' % i, 'smiles')) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(StubHandler.connections, 2)
+
+
+class TestBatch(StubTestCase):
+    """Test the concurrent resolve_many and query_many functions."""
+
+    def test_resolve_many(self):
+        """Test that results are returned in input order with errors captured."""
+        inputs = ['Aspirin%s' % i for i in range(20)] + ['busy', 'empty']
+        results = cirpy.resolve_many(inputs, 'smiles', max_workers=4)
+        self.assertEqual(results[:20], ['smiles-Aspirin%s' % i for i in range(20)])
+        self.assertIsInstance(results[20], HTTPError)
+        self.assertIsNone(results[21])
+
+    def test_query_many(self):
+        """Test that query_many returns a list of results for each input."""
+        results = cirpy.query_many(['Aspirin', 'empty'], 'formula')
+        self.assertEqual(results[0][0].value, 'formula-Aspirin')
+        self.assertEqual(results[1], [])
+
+
+@unittest.skipIf(cirpy_async is None, 'asyncio client requires Python 3.5+')
+class TestAsync(StubTestCase):
+    """Test the asyncio client."""
+
+    def setUp(self):
+        super(TestAsync, self).setUp()
+        cirpy_async.configure_pool(max_concurrency=3)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        cirpy_async._pool.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(TestAsync, self).tearDown()
+
+    def test_aresolve_many(self):
+        """Test many concurrent coroutine lookups share a few keep-alive connections."""
+        inputs = ['Aspirin%s' % i for i in range(30)]
+        coroutines = [cirpy_async.aresolve(input, 'smiles') for input in inputs]
+        results = self.loop.run_until_complete(asyncio.gather(*coroutines))
+        self.assertEqual(results, ['smiles-%s' % input for input in inputs])
+        self.assertLessEqual(StubHandler.connections, 3)
+
+    def test_aquery_errors(self):
+        """Test empty results and HTTP errors."""
+        self.assertEqual(self.loop.run_until_complete(cirpy_async.aquery('empty', 'smiles')), [])
+        with self.assertRaises(HTTPError):
+            self.loop.run_until_complete(cirpy_async.aquery('missing', 'smiles'))
+
+    def test_aredirect_without_location(self):
+        """Test that a redirect without a Location header raises HTTPError, like the sync pool."""
+        with self.assertRaises(HTTPError) as context:
+            self.loop.run_until_complete(cirpy_async.aresolve('nolocation', 'smiles'))
+        self.assertEqual(context.exception.code, 302)
+        self.assertEqual(len(StubHandler.paths), 1)
+
+    def test_aresolve_image(self):
+        """Test image requests use the same URL as resolve_image."""
+        self.assertEqual(self.loop.run_until_complete(cirpy_async.aresolve_image('Glucose', width=100)), b'image-Glucose')
+        self.assertIn('width=100', StubHandler.paths[-1])
+        self.assertIn('height=300', StubHandler.paths[-1])
+
+
+class TestPrefetch(StubTestCase):
+    """Test concurrent prefetching of Molecule properties."""
+
+    def test_prefetch(self):
+        """Test that prefetched properties are cached and not requested again."""
+        mol = Molecule('Aspirin')
+        mol.prefetch(['smiles', 'stdinchikey', 'mw'])
+        self.assertEqual(len(StubHandler.paths), 3)
+        self.assertEqual(mol.smiles, 'smiles-Aspirin')
+        self.assertEqual(mol.mw, 'mw-Aspirin')
+        self.assertEqual(len(StubHandler.paths), 3)
+
+    def test_prefetch_all(self):
+        """Test that prefetch_all resolves every memoized property."""
+        mol = Molecule('Aspirin')
+        mol.prefetch_all()
+        self.assertEqual(len(StubHandler.paths), len(Molecule.memoized_properties()))
+        self.assertEqual(mol.formula, 'formula-Aspirin')
+        self.assertEqual(mol.image, b'image-Aspirin')
+
+    def test_prefetch_invalid(self):
+        """Test that unknown property names are rejected."""
+        with self.assertRaises(AttributeError):
+            Molecule('Aspirin').prefetch(['image_url'])
+
+
+class TestIdentityIndex(StubTestCase):
+    """Test sharing of structure properties between Molecules with the same Standard InChIKey."""
+
+    def tearDown(self):
+        cirpy.disable_identity_index()
+        super(TestIdentityIndex, self).tearDown()
+
+    def test_shared_properties(self):
+        """Test that properties are resolved once per structure, whatever the input."""
+        cirpy.enable_identity_index()
+        self.assertEqual(Molecule('Aspirin~name').smiles, 'smiles-Aspirin~name')
+        self.assertEqual(len(StubHandler.paths), 2)
+        mol = Molecule('Aspirin~cas')
+        self.assertEqual(mol.smiles, 'smiles-Aspirin~name')
+        self.assertEqual(mol.mw, 'mw-Aspirin~cas')
+        self.assertEqual(len(StubHandler.paths), 4)
+        self.assertEqual(Molecule('Aspirin~name').mw, 'mw-Aspirin~cas')
+        self.assertEqual(Molecule('Aspirin~smiles').formula, 'formula-Aspirin~smiles')
+        self.assertEqual(len(StubHandler.paths), 6)
+        self.assertEqual(Molecule('Aspirin~name').iupac_name, 'iupac_name-Aspirin~name')
+        self.assertEqual(cirpy.identity_index_stats()['structures'], 1)
+
+    def test_known_key(self):
+        """Test that without fetch_key, aliases are only linked once their InChIKey has been resolved."""
+        cirpy.enable_identity_index(fetch_key=False)
+        mol = Molecule('Aspirin~name')
+        self.assertEqual(mol.smiles, 'smiles-Aspirin~name')
+        self.assertEqual(Molecule('Aspirin~cas').smiles, 'smiles-Aspirin~cas')
+        self.assertEqual(mol.stdinchikey, 'stdinchikey-Aspirin')
+        mol = Molecule('Aspirin~cas')
+        self.assertEqual(mol.stdinchikey, 'stdinchikey-Aspirin')
+        self.assertEqual(mol.smiles, 'smiles-Aspirin~name')
+        self.assertEqual(len(StubHandler.paths), 4)
+
+    def test_disabled(self):
+        """Test that properties are not shared by default."""
+        Molecule('Aspirin~name').smiles
+        Molecule('Aspirin~name').smiles
+        self.assertEqual(len(StubHandler.paths), 2)
+        self.assertIsNone(cirpy.identity_index_stats())
+
+
+class TestMoleculeStore(StubTestCase):
+    """Test serializing Molecules and saving them in a MoleculeStore."""
+
+    def setUp(self):
+        super(TestMoleculeStore, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'molecules.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestMoleculeStore, self).tearDown()
+
+    def test_round_trip(self):
+        """Test that resolved properties survive to_dict, from_dict and pickling without new requests."""
+        mol = Molecule('Aspirin', resolvers=['name_by_opsin'])
+        mol.smiles
+        mol.names
+        self.assertEqual(mol.to_dict()['properties'], {'smiles': 'smiles-Aspirin',
+                                                       'names': ['names-Aspirin', 'names-Aspirin-2']})
+        for copy in [Molecule.from_dict(mol.to_dict()), pickle.loads(pickle.dumps(mol))]:
+            self.assertEqual(copy.resolvers, ['name_by_opsin'])
+            self.assertEqual(copy.smiles, 'smiles-Aspirin')
+            self.assertEqual(copy.names, ['names-Aspirin', 'names-Aspirin-2'])
+        self.assertEqual(len(StubHandler.paths), 2)
+
+    def test_store(self):
+        """Test that Molecules are saved and loaded in bulk, including binary properties."""
+        molecules = [Molecule('Aspirin'), Molecule('Morphine'), Molecule('Glucose')]
+        for mol in molecules:
+            mol.prefetch(['smiles', 'mw', 'image'])
+        store = cirpy.MoleculeStore(self.path)
+        self.assertEqual(store.save(molecules), 3)
+        self.assertEqual(os.listdir(self.tempdir), ['molecules.jsonl.gz'])
+        loaded = store.load()
+        self.assertEqual([mol.input for mol in loaded], ['Aspirin', 'Morphine', 'Glucose'])
+        self.assertEqual(loaded[1].mw, 'mw-Morphine')
+        self.assertEqual(loaded[2].image, b'image-Glucose')
+        self.assertEqual(len(StubHandler.paths), 9)
+        self.assertEqual(loaded[0].formula, 'formula-Aspirin')
+        self.assertEqual(len(StubHandler.paths), 10)
+
+
+def molfile(atoms, bonds, properties=()):
+    """Return a V2000 molfile for a list of (symbol, charge code) atoms and (begin, end, order) bonds."""
+    lines = ['', '  test', '', '%3d%3d  0  0  0  0  0  0  0  0999 V2000' % (len(atoms), len(bonds))]
+    lines += ['    0.0000    0.0000    0.0000 %-3s 0%3d  0  0  0  0  0  0  0  0  0  0' % atom for atom in atoms]
+    lines += ['%3d%3d%3d  0' % bond for bond in bonds]
+    return '\n'.join(lines + list(properties) + ['M  END', '$$$$', ''])
+
+
+def ring(start, size=6, orders=(1, 2)):
+    """Return the bonds of a ring of atoms numbered from start."""
+    return [(start + i, start + (i + 1) % size, orders[i % len(orders)]) for i in range(size)]
+
+
+class TestLocalDescriptors(StubTestCase):
+    """Test descriptors computed locally from the SDF connection table."""
+
+    def tearDown(self):
+        cirpy.disable_local_descriptors()
+        StubHandler.molfiles = {}
+        super(TestLocalDescriptors, self).tearDown()
+
+    def test_rings(self):
+        """Test ring, ring system and rotor counts for biphenyl and naphthalene."""
+        biphenyl = cirpy.ConnectionTable.from_molfile(molfile([('C', 0)] * 12, ring(1) + ring(7) + [(1, 7, 1)]))
+        self.assertEqual(biphenyl.descriptors(), {'formula': 'C12H10', 'mw': '154.2078', 'ring_count': '2',
+                                                  'ringsys_count': '2', 'rotor_count': '1',
+                                                  'h_bond_donor_count': '0'})
+        naphthalene = cirpy.ConnectionTable.from_molfile(molfile([('C', 0)] * 10, ring(1) + [
+            (1, 7, 1), (7, 8, 2), (8, 9, 1), (9, 10, 2), (10, 2, 1)]))
+        self.assertEqual(naphthalene.formula(), 'C10H8')
+        self.assertEqual((naphthalene.ring_count(), naphthalene.ringsys_count()), (2, 1))
+
+    def test_charges_and_hydrogens(self):
+        """Test that charges and explicit hydrogens are taken into account."""
+        ethylammonium = molfile([('C', 0), ('C', 0), ('N', 0), ('Cl', 0)], [(1, 2, 1), (2, 3, 1)],
+                                ['M  CHG  2   3   1   4  -1'])
+        table = cirpy.ConnectionTable.from_molfile(ethylammonium)
+        self.assertEqual((table.formula(), table.h_bond_donor_count(), table.rotor_count()), ('C2H8ClN', 1, 0))
+        methanol = molfile([('C', 0), ('O', 0)] + [('H', 0)] * 4, [(1, 2, 1), (1, 3, 1), (1, 4, 1), (1, 5, 1),
+                                                                    (2, 6, 1)])
+        table = cirpy.ConnectionTable.from_molfile(methanol)
+        self.assertEqual(table.descriptors()['formula'], 'CH4O')
+        self.assertEqual(table.descriptors()['mw'], '32.0419')
+        self.assertEqual(cirpy.ConnectionTable.from_molfile(molfile([('O', 5)], [])).formula(), 'HO')
+        pyrrole = cirpy.ConnectionTable.from_molfile(molfile([('N', 0)] + [('C', 0)] * 4, ring(1, 5)))
+        self.assertEqual((pyrrole.formula(), pyrrole.h_bond_donor_count()), ('C4H5N', 1))
+
+    def test_invalid(self):
+        """Test that unsupported molfiles are rejected."""
+        with self.assertRaises(ValueError):
+            cirpy.ConnectionTable.from_molfile(molfile([('R', 0)], []))
+        with self.assertRaises(ValueError):
+            cirpy.ConnectionTable.from_molfile('\n\n\n  0  0  0     0  0  0  0  0  0999 V3000\n')
+        with self.assertRaises(ValueError):
+            cirpy.ConnectionTable.from_molfile(molfile([('C', 0), ('C', 0)], [(1, 2, 8)]))
+
+    def test_ambiguous_hydrogens(self):
+        """Test that hydrogens are not guessed for aromatic bonds or molecules without heavy atoms."""
+        pyrrole = cirpy.ConnectionTable.from_molfile(molfile([('N', 0)] + [('C', 0)] * 4, ring(1, 5, (4,))))
+        with self.assertRaises(ValueError):
+            pyrrole.descriptors()
+        hydrogen = cirpy.ConnectionTable.from_molfile(molfile([('H', 0), ('H', 0)], [(1, 2, 1)]))
+        with self.assertRaises(ValueError):
+            hydrogen.descriptors()
+
+    def test_molecule(self):
+        """Test that Molecule descriptors need a single SDF request, and fall back to CIR if it cannot be parsed."""
+        StubHandler.molfiles['Biphenyl'] = molfile([('C', 0)] * 12, ring(1) + ring(7) + [(1, 7, 1)])
+        cirpy.enable_local_descriptors()
+        mol = Molecule('Biphenyl')
+        self.assertEqual(mol.formula, 'C12H10')
+        self.assertEqual((mol.ring_count, mol.ringsys_count, mol.rotor_count), ('2', '2', '1'))
+        self.assertEqual(mol.h_bond_donor_count, '0')
+        self.assertEqual(len(StubHandler.paths), 1)
+        self.assertEqual(Molecule('Aspirin').mw, 'mw-Aspirin')
+        self.assertEqual(len(StubHandler.paths), 3)
+        self.assertEqual(Molecule('missing').formula, None)
+        StubHandler.molfiles['Pyrrole'] = molfile([('N', 0)] + [('C', 0)] * 4, ring(1, 5, (4,)))
+        mol = Molecule('Pyrrole')
+        self.assertEqual((mol.formula, mol.h_bond_donor_count), ('formula-Pyrrole', 'h_bond_donor_count-Pyrrole'))
+        self.assertEqual(len(StubHandler.paths), 7)
+
+
+class TestResponseCache(StubTestCase):
+    """Test the persistent on-disk response cache."""
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cache.sqlite')
+
+    def tearDown(self):
+        cirpy.disable_cache()
+        shutil.rmtree(self.tempdir)
+        super(TestResponseCache, self).tearDown()
+
+    def test_cache_hit(self):
+        """Test that repeated requests are served from the cache, including after reopening it."""
+        cirpy.enable_cache(self.path)
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(resolve_image('Aspirin'), b'image-Aspirin')
+        self.assertEqual(resolve_image('Aspirin'), b'image-Aspirin')
+        self.assertEqual(cirpy.cache_stats(), {'hits': 2, 'misses': 2, 'size': 2})
+        cirpy.enable_cache(self.path)
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(len(StubHandler.paths), 2)
+
+    def test_cache_expiry(self):
+        """Test that expired entries are fetched again."""
+        cirpy.enable_cache(self.path, ttl=-1)
+        resolve('Aspirin', 'smiles')
+        resolve('Aspirin', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 2)
+
+    def test_cache_eviction(self):
+        """Test that the least recently used entries are evicted."""
+        cirpy.enable_cache(self.path, maxsize=2)
+        cirpy._cache.touch_interval = 0
+        resolve('Aspirin', 'smiles')
+        resolve('Morphine', 'smiles')
+        resolve('Aspirin', 'smiles')
+        resolve('Caffeine', 'smiles')
+        self.assertEqual(cirpy.cache_stats()['size'], 2)
+        resolve('Aspirin', 'smiles')
+        resolve('Morphine', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 4)
+
+    def test_cache_hit_writes(self):
+        """Test that hits only update the access time once it is older than the touch interval."""
+        cache = cirpy.ResponseCache(self.path)
+        cache.set('a', b'1')
+        changes = cache._db.total_changes
+        for _ in range(3):
+            self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache._db.total_changes, changes)
+        cache.touch_interval = 0
+        cache.get('a')
+        self.assertEqual(cache._db.total_changes, changes + 1)
+        cache.close()
+
+    def test_cache_shared(self):
+        """Test that maxsize holds when several processes share the database."""
+        caches = [cirpy.ResponseCache(self.path, maxsize=2) for _ in range(2)]
+        for i in range(6):
+            caches[i % 2].set('url%s' % i, b'body')
+        self.assertEqual([cache.stats()['size'] for cache in caches], [2, 2])
+        self.assertEqual(caches[0].get('url5'), b'body')
+        for cache in caches:
+            cache.close()
+
+    def test_cache_disabled(self):
+        """Test that cache_stats returns None when caching is not enabled."""
+        self.assertIsNone(cirpy.cache_stats())
+
+
+class TestNegativeCache(StubTestCase):
+    """Test caching of inputs that could not be resolved."""
+
+    def setUp(self):
+        super(TestNegativeCache, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        cirpy.disable_negative_cache()
+        cirpy.disable_cache()
+        shutil.rmtree(self.tempdir)
+        super(TestNegativeCache, self).tearDown()
+
+    def test_not_found(self):
+        """Test that 404 errors are raised again without contacting CIR."""
+        cirpy.enable_negative_cache()
+        for _ in range(2):
+            with self.assertRaises(HTTPError) as cm:
+                query('missing', 'smiles')
+            self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(len(StubHandler.paths), 1)
+        self.assertEqual(cirpy.negative_cache_stats()['hits'], 1)
+
+    def test_empty_result(self):
+        """Test that empty results are stored separately from the response cache."""
+        cirpy.enable_cache(os.path.join(self.tempdir, 'cache.sqlite'))
+        cirpy.enable_negative_cache(os.path.join(self.tempdir, 'cache.sqlite'), ttl=60)
+        self.assertIsNone(resolve('empty', 'smiles'))
+        self.assertIsNone(resolve('empty', 'smiles'))
+        self.assertEqual(len(StubHandler.paths), 1)
+        self.assertEqual(cirpy.cache_stats()['size'], 0)
+        self.assertEqual(cirpy.negative_cache_stats()['size'], 1)
+
+    def test_negative_expiry(self):
+        """Test that expired negative entries are requested again."""
+        cirpy.enable_negative_cache(ttl=-1)
+        resolve('empty', 'smiles')
+        resolve('empty', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 2)
+
+
+class TestSingleFlight(StubTestCase):
+    """Test that identical concurrent requests are coalesced."""
+
+    def run_threads(self, func, args, count=10):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func(*args))) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        """Test that concurrent identical lookups make a single request and share the result."""
+        results = self.run_threads(resolve, ('slow', 'smiles'))
+        self.assertEqual(results, ['smiles-slow'] * 10)
+        self.assertEqual(len(StubHandler.paths), 1)
+
+    def test_coalesce_errors(self):
+        """Test that every waiting caller receives the error."""
+        results = self.run_threads(cirpy.resolve_many, (['slowbusy'], 'smiles'))
+        self.assertTrue(all(isinstance(result[0], HTTPError) for result in results))
+        self.assertEqual(len(StubHandler.paths), 1)
+        self.assertEqual(len(set(id(result[0]) for result in results)), 10)
+        self.assertEqual([result[0].read() for result in results], [b'Service Unavailable'] * 10)
+
+
+class TestRateLimit(StubTestCase):
+    """Test the client-side rate limiter."""
+
+    def tearDown(self):
+        cirpy.disable_rate_limit()
+        super(TestRateLimit, self).tearDown()
+
+    def test_rate(self):
+        """Test that requests are spaced according to the rate."""
+        cirpy.enable_rate_limit(rate=20, burst=1)
+        start = time.time()
+        cirpy.resolve_many(['Aspirin%s' % i for i in range(6)], 'smiles')
+        self.assertGreaterEqual(time.time() - start, 0.24)
+
+    def test_adaptive(self):
+        """Test that the rate is reduced after throttling responses and recovers after successful ones."""
+        cirpy.enable_rate_limit(rate=100, min_rate=10, recovery=5)
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                resolve('busy', 'smiles')
+        self.assertEqual(cirpy._limiter.current_rate, 25)
+        resolve('Aspirin', 'smiles')
+        self.assertEqual(cirpy._limiter.current_rate, 30)
+
+    def test_concurrency(self):
+        """Test that max_concurrency caps simultaneous requests."""
+        cirpy.enable_rate_limit(rate=None, max_concurrency=1)
+        start = time.time()
+        cirpy.resolve_many(['slow%s' % i for i in range(3)], 'smiles', max_workers=3)
+        self.assertGreaterEqual(time.time() - start, 0.6)
+
+
+class TestRetries(StubTestCase):
+    """Test the retry policy and circuit breaker."""
+
+    def tearDown(self):
+        cirpy.disable_retries()
+        cirpy.disable_circuit_breaker()
+        super(TestRetries, self).tearDown()
+
+    def test_retry(self):
+        """Test that transient errors are retried until the request succeeds."""
+        cirpy.enable_retries(max_attempts=3, backoff=0.01)
+        self.assertEqual(resolve('flaky', 'smiles'), 'smiles-flaky')
+        self.assertEqual(len(StubHandler.paths), 3)
+
+    def test_retry_exhausted(self):
+        """Test that the error is raised once attempts are exhausted, and 404 errors are not retried."""
+        cirpy.enable_retries(max_attempts=2, backoff=0.01)
+        with self.assertRaises(HTTPError):
+            resolve('flaky', 'smiles')
+        with self.assertRaises(HTTPError):
+            query('missing', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 3)
+
+    def test_circuit_breaker(self):
+        """Test that the circuit opens after sustained failures and closes after a successful trial request."""
+        cirpy.enable_circuit_breaker(failure_threshold=2, cooldown=0.2)
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                resolve('busy', 'smiles')
+        with self.assertRaises(cirpy.CircuitOpenError):
+            resolve('Aspirin', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 2)
+        time.sleep(0.2)
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(resolve('Morphine', 'smiles'), 'smiles-Morphine')
+
+
+class TestTransport(StubTestCase):
+    """Test the pluggable transports."""
+
+    def setUp(self):
+        super(TestTransport, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'responses.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestTransport, self).tearDown()
+
+    def test_urllib_transport(self):
+        """Test that requests can be made with urllib instead of the connection pool."""
+        cirpy.set_transport(cirpy.UrllibTransport())
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(query('Aspirin', 'smiles')[0].value, 'smiles-Aspirin')
+        with self.assertRaises(HTTPError):
+            query('missing', 'smiles')
+
+    def test_record_replay(self):
+        """Test that recorded responses, including errors, are replayed without making requests."""
+        cirpy.set_transport(cirpy.RecordingTransport(self.path))
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertIsNone(resolve('missing', 'smiles'))
+        self.assertEqual(len(StubHandler.paths), 2)
+        cirpy.set_transport(cirpy.ReplayTransport(self.path))
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertIsNone(resolve('missing', 'smiles'))
+        with self.assertRaises(KeyError):
+            resolve('Morphine', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 2)
+
+    def test_replay_fallback(self):
+        """Test that URLs that were not recorded are passed to the fallback transport."""
+        io.open(self.path, 'w').close()
+        cirpy.set_transport(cirpy.ReplayTransport(self.path, fallback=cirpy.get_transport()))
+        self.assertEqual(resolve('Morphine', 'smiles'), 'smiles-Morphine')
+        self.assertEqual(len(StubHandler.paths), 1)
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'httpx requires Python 3.6+')
+    def test_httpx_transport(self):
+        """Test requests made with httpx, if it is installed."""
+        try:
+            transport = cirpy.HttpxTransport(http2=False)
+        except ImportError:
+            self.skipTest('httpx is not installed')
+        cirpy.set_transport(transport)
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        with self.assertRaises(HTTPError):
+            query('missing', 'smiles')
+
+
+class TestHedging(StubTestCase):
+    """Test hedged requests."""
+
+    def tearDown(self):
+        cirpy.disable_hedging()
+        super(TestHedging, self).tearDown()
+
+    def test_hedge(self):
+        """Test that a duplicate request is sent when the first is slow, and the fastest response is used."""
+        cirpy.enable_hedging(initial_delay=0.05, max_ratio=1)
+        start = time.time()
+        self.assertEqual(resolve('stall', 'smiles'), 'smiles-stall')
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(len(StubHandler.paths), 2)
+        self.assertEqual(cirpy.hedging_stats(), {'requests': 1, 'hedges': 1, 'hedge_wins': 1})
+
+    def test_no_hedge_threads(self):
+        """Test that requests that are not hedged are made in the calling thread, without starting new threads."""
+        cirpy.enable_hedging(initial_delay=1)
+        resolve('Aspirin0', 'smiles')
+        threads = threading.active_count()
+        for i in range(1, 5):
+            self.assertEqual(resolve('Aspirin%s' % i, 'smiles'), 'smiles-Aspirin%s' % i)
+            self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(cirpy.hedging_stats(), {'requests': 5, 'hedges': 0, 'hedge_wins': 0})
+
+    def test_hedge_concurrent(self):
+        """Test that hedges use reserved connections and win when every per-host connection is stalled."""
+        cirpy.configure_pool(per_host=4)
+        cirpy.enable_hedging(initial_delay=0.05, max_ratio=1)
+        inputs = ['stall%s' % i for i in range(4)]
+        start = time.time()
+        self.assertEqual(cirpy.resolve_many(inputs, 'smiles', max_workers=4), ['smiles-%s' % i for i in inputs])
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(cirpy.hedging_stats(), {'requests': 4, 'hedges': 4, 'hedge_wins': 4})
+        # The stalled requests are aborted and their connections released without waiting for a response
+        time.sleep(0.1)
+        self.assertEqual(sum(cirpy.get_transport()._active.values()), 0)
+
+    def test_hedge_limit(self):
+        """Test that no more than max_ratio of requests are hedged."""
+        cirpy.enable_hedging(initial_delay=0.05, max_ratio=0.5)
+        self.assertEqual(resolve('slow1', 'smiles'), 'smiles-slow1')
+        self.assertEqual(resolve('slow2', 'smiles'), 'smiles-slow2')
+        self.assertEqual(len(StubHandler.paths), 3)
+        self.assertEqual(cirpy.hedging_stats()['hedges'], 1)
+        with self.assertRaises(HTTPError):
+            query('missing', 'smiles')
+
+    def test_hedge_delay(self):
+        """Test that the delay is the percentile of observed latencies, within the limits."""
+        policy = cirpy.HedgePolicy(percentile=90, initial_delay=2, min_delay=0.05, max_delay=0.5, min_samples=10)
+        self.assertEqual(policy.delay(), 0.5)
+        for i in range(100):
+            policy.observe(i / 200)
+        self.assertEqual(policy.delay(), 0.45)
+        policy = cirpy.HedgePolicy(min_delay=0.05, min_samples=1)
+        policy.observe(0.001)
+        self.assertEqual(policy.delay(), 0.05)
+
+
+class TestCompression(StubTestCase):
+    """Test gzip and deflate compressed responses."""
+
+    def test_gzip(self):
+        """Test that compressed responses are decompressed and the bytes saved are counted."""
+        before = cirpy.transfer_stats()
+        results = query('multi50', 'names')
+        self.assertEqual(len(results), 50)
+        self.assertEqual(results[49].value, ['names-multi50-49', 'names-multi50-2-49'])
+        after = cirpy.transfer_stats()
+        self.assertGreater(after['bytes_saved'] - before['bytes_saved'], 0)
+        self.assertLess(after['bytes_received'] - before['bytes_received'],
+                        after['bytes_decoded'] - before['bytes_decoded'])
+
+    def test_raw_deflate(self):
+        """Test that deflate responses without a zlib header are decompressed."""
+        self.assertEqual(resolve('deflate', 'names'), ['names-deflate', 'names-deflate-2'])
+        self.assertEqual(query('deflate', 'smiles')[0].value, 'smiles-deflate')
+
+    def test_uncompressed(self):
+        """Test that compression can be turned off."""
+        cirpy.configure_pool(compress=False)
+        before = cirpy.transfer_stats()
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        after = cirpy.transfer_stats()
+        self.assertEqual(after['bytes_saved'], before['bytes_saved'])
+        self.assertEqual(after['bytes_received'] - before['bytes_received'], len(b'smiles-Aspirin'))
+
+    def test_urllib_transport(self):
+        """Test that the urllib transport also decompresses responses."""
+        cirpy.set_transport(cirpy.UrllibTransport())
+        self.assertEqual(query('multi3', 'smiles')[2].value, 'smiles-multi3-2')
+
+    def test_compressed_error(self):
+        """Test that compressed error response bodies are decompressed by every transport."""
+        for transport in [cirpy.ConnectionPool(), cirpy.UrllibTransport()]:
+            cirpy.set_transport(transport)
+            with self.assertRaises(HTTPError) as context:
+                query('missingcompressed', 'smiles')
+            self.assertEqual(context.exception.read(), b'Page not found (404)')
+
+
+class TestHooks(StubTestCase):
+    """Test event hooks and the Metrics collector."""
+
+    def setUp(self):
+        super(TestHooks, self).setUp()
+        self.events = []
+        self.metrics = cirpy.Metrics()
+        cirpy.add_hook(self.events.append)
+        cirpy.add_hook(self.metrics)
+
+    def tearDown(self):
+        cirpy.remove_hook(self.events.append)
+        cirpy.remove_hook(self.metrics)
+        cirpy.disable_retries()
+        cirpy.configure_query_cache(0)
+        cirpy.clear_query_cache()
+        super(TestHooks, self).tearDown()
+
+    def test_request_events(self):
+        """Test that request and parse events describe each request."""
+        cirpy.enable_retries(max_attempts=3, backoff=0.01)
+        query('flaky', 'smiles', resolvers=['name_by_opsin'])
+        request, parse = self.events
+        self.assertEqual(request['event'], 'request')
+        self.assertEqual(request['representation'], 'smiles')
+        self.assertEqual(request['resolvers'], ['name_by_opsin'])
+        self.assertEqual(request['status'], 200)
+        self.assertEqual(request['retries'], 2)
+        self.assertGreater(request['bytes'], 0)
+        self.assertIsNone(request['error'])
+        self.assertEqual(parse['event'], 'parse')
+        self.assertEqual(parse['results'], 1)
+
+    def test_error_event(self):
+        """Test that failed requests emit an event with the error and status."""
+        with self.assertRaises(HTTPError):
+            query('missing', 'smiles')
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0]['status'], 404)
+        self.assertIsInstance(self.events[0]['error'], HTTPError)
+
+    def test_circuit_open_event(self):
+        """Test that requests rejected by an open circuit breaker emit a request event."""
+        cirpy.enable_circuit_breaker(failure_threshold=1, cooldown=60)
+        try:
+            with self.assertRaises(HTTPError):
+                resolve('busy', 'smiles')
+            with self.assertRaises(cirpy.CircuitOpenError):
+                resolve('Aspirin', 'smiles')
+        finally:
+            cirpy.disable_circuit_breaker()
+        requests = [e for e in self.events if e['event'] == 'request']
+        self.assertEqual(len(requests), 2)
+        self.assertIsInstance(requests[1]['error'], cirpy.CircuitOpenError)
+        self.assertEqual(requests[1]['representation'], 'smiles')
+
+    def test_cache_events(self):
+        """Test that cache lookups emit hit and miss events."""
+        cirpy.configure_query_cache(maxsize=10)
+        query('Aspirin', 'smiles')
+        query('Aspirin', 'smiles')
+        hits = [e['hit'] for e in self.events if e['event'] == 'cache']
+        self.assertEqual(hits, [False, True])
+
+    def test_event_representation(self):
+        """Test that events are labelled with the requested representation, even if the input contains slashes."""
+        resolve('InChI=1S/CH4/h1H4', 'smiles', resolvers=['stdinchi'])
+        resolve('Aspirin', 'sdf')
+        self.assertEqual([(e['event'], e['representation'], e['resolvers']) for e in self.events], [
+            ('request', 'smiles', ['stdinchi']), ('parse', 'smiles', ['stdinchi']),
+            ('request', 'sdf', None), ('parse', 'sdf', None),
+        ])
+
+    def test_metrics(self):
+        """Test that Metrics aggregates counters and histograms by representation."""
+        cirpy.configure_query_cache(maxsize=10)
+        for input in ['Aspirin', 'Aspirin', 'Morphine']:
+            query(input, 'smiles')
+        with self.assertRaises(HTTPError):
+            query('missing', 'smiles')
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot[('requests', 'smiles', 200)], 2)
+        self.assertEqual(snapshot[('requests', 'smiles', 404)], 1)
+        self.assertEqual(snapshot[('cache_hits', 'query')], 1)
+        self.assertEqual(snapshot[('cache_misses', 'query')], 3)
+        self.assertEqual(snapshot[('latency', 'smiles')]['count'], 3)
+        self.assertEqual(snapshot[('latency', 'smiles')]['buckets'][-1], ('+Inf', 3))
+        self.metrics.reset()
+        self.assertEqual(self.metrics.snapshot(), {})
+
+    def test_hook_error(self):
+        """Test that exceptions raised by hooks do not break requests."""
+        def broken(event):
+            raise ValueError(event)
+        cirpy.add_hook(broken)
+        try:
+            self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        finally:
+            cirpy.remove_hook(broken)
+
+
+class TestQueryIter(StubTestCase):
+    """Test incremental parsing of query results."""
+
+    def test_query_iter(self):
+        """Test that query_iter yields every result in order."""
+        values = [result.value for result in cirpy.query_iter('multi5', 'smiles')]
+        self.assertEqual(values, ['smiles-multi5'] + ['smiles-multi5-%s' % i for i in range(1, 5)])
+        self.assertEqual([r.value for r in query('multi5', 'smiles')], values)
+
+    def test_resolve_first(self):
+        """Test that resolve returns the first result of a multi-result response."""
+        self.assertEqual(resolve('multi100', 'smiles'), 'smiles-multi100')
+
+    def test_query_iter_empty(self):
+        """Test that query_iter yields nothing for an empty response and raises errors immediately."""
+        self.assertEqual(list(cirpy.query_iter('empty', 'smiles')), [])
+        with self.assertRaises(HTTPError):
+            cirpy.query_iter('missing', 'smiles')
+
+
+class TestPlainResolve(StubTestCase):
+    """Test that resolve uses the plain text API where possible."""
+
+    def test_plain(self):
+        """Test that common representations are requested as plain text."""
+        self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        self.assertEqual(resolve('Aspirin', 'names'), ['names-Aspirin', 'names-Aspirin-2'])
+        self.assertEqual(query('Aspirin', 'names')[0].value, ['names-Aspirin', 'names-Aspirin-2'])
+        self.assertIsNone(resolve('empty', 'smiles'))
+        self.assertFalse(StubHandler.paths[0].endswith('/xml'))
+
+    def test_multiple_matches(self):
+        """Test that only the first of several matches is returned."""
+        self.assertEqual(resolve('multi2', 'stdinchi'), 'stdinchi-multi2')
+        self.assertEqual(resolve('multi3', 'smiles'), 'smiles-multi3')
+        self.assertEqual(resolve('multi2', 'names'), ['names-multi2', 'names-multi2-2'])
+        self.assertEqual(resolve('multi2', 'cas'), 'cas-multi2')
+        self.assertTrue(StubHandler.paths[2].endswith('/xml'))
+
+    def test_xml_fallback(self):
+        """Test that other representations still use the XML API."""
+        self.assertEqual(resolve('Aspirin', 'chemspider_id'), 'chemspider_id-Aspirin')
+        self.assertTrue(StubHandler.paths[0].endswith('/xml'))
+
+
+class TestImageStore(StubTestCase):
+    """Test batch image rendering into a content-addressed directory."""
+
+    def setUp(self):
+        super(TestImageStore, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestImageStore, self).tearDown()
+
+    def test_resolve_images(self):
+        """Test that images are saved once per input and rendering options, and errors are returned in place."""
+        paths = cirpy.resolve_images(['Aspirin', 'Morphine', 'missing', 'busy'], self.tempdir, width=100)
+        self.assertEqual(len(StubHandler.paths), 4)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'image-Aspirin')
+        self.assertTrue(paths[1].endswith('.png'))
+        self.assertIsNone(paths[2])
+        self.assertIsInstance(paths[3], HTTPError)
+        self.assertEqual(cirpy.resolve_images(['Aspirin', 'Morphine'], self.tempdir, width=100), paths[:2])
+        self.assertEqual(len(StubHandler.paths), 4)
+        other = cirpy.resolve_images(['Aspirin'], self.tempdir, width=100, fmt='gif')
+        self.assertNotEqual(other[0], paths[0])
+        self.assertEqual(len(StubHandler.paths), 5)
+
+    def test_defaults_normalized(self):
+        """Test that explicitly passing default rendering options uses the same stored image."""
+        path = Molecule('Aspirin').image_file(self.tempdir)
+        self.assertEqual(Molecule('Aspirin').image_file(self.tempdir, width=300, fmt='png'), path)
+        self.assertEqual(len(StubHandler.paths), 1)
+        self.assertEqual([f for f in os.listdir(os.path.dirname(path)) if f.startswith('.')], [])
+
+
+class TestDownload(StubTestCase):
+    """Test streaming downloads to files."""
+
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestDownload, self).tearDown()
+
+    def test_download(self):
+        """Test that the file is written with a trailing newline and no temporary files are left behind."""
+        filename = os.path.join(self.tempdir, 'aspirin.sdf')
+        cirpy.download('Aspirin', filename, 'sdf')
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'sdf-Aspirin\n')
+        with self.assertRaises(IOError):
+            cirpy.download('Aspirin', filename, 'sdf')
+        cirpy.download('empty', os.path.join(self.tempdir, 'empty.sdf'), 'sdf')
+        self.assertEqual(os.listdir(self.tempdir), ['aspirin.sdf'])
+
+    def test_download_first_match(self):
+        """Test that only the first match is saved for line-based representations, like resolve."""
+        filename = os.path.join(self.tempdir, 'multi.smi')
+        cirpy.download('multi3', filename, 'smiles')
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'smiles-multi3\n')
+
+    def test_download_permissions(self):
+        """Test that downloaded and stored files get the same permissions as files created normally."""
+        reference = os.path.join(self.tempdir, 'reference')
+        open(reference, 'w').close()
+        mode = os.stat(reference).st_mode & 0o777
+        filename = os.path.join(self.tempdir, 'aspirin.sdf')
+        cirpy.download('Aspirin', filename, 'sdf')
+        image = Molecule('Aspirin').image_file(os.path.join(self.tempdir, 'images'))
+        store = cirpy.MoleculeStore(os.path.join(self.tempdir, 'molecules.jsonl.gz'))
+        store.save([Molecule('Aspirin')])
+        for path in [filename, image, store.path]:
+            self.assertEqual(os.stat(path).st_mode & 0o777, mode)
+
+    def test_local_error(self):
+        """Test that errors writing the file are raised without retrying or tripping the circuit breaker."""
+        class FullFile(io.BytesIO):
+            def write(self, data):
+                raise IOError(errno.ENOSPC, 'No space left on device')
+        cirpy.enable_retries(max_attempts=3, backoff=0.01)
+        cirpy.enable_circuit_breaker(failure_threshold=1, cooldown=60)
+        fdopen = os.fdopen
+        os.fdopen = lambda fd, mode: os.close(fd) or FullFile()
+        try:
+            with self.assertRaises(IOError) as context:
+                cirpy.download('Aspirin', os.path.join(self.tempdir, 'aspirin.sdf'), 'sdf')
+            self.assertEqual(context.exception.errno, errno.ENOSPC)
+            self.assertEqual(len(StubHandler.paths), 1)
+        finally:
+            os.fdopen = fdopen
+        try:
+            self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+        finally:
+            cirpy.disable_circuit_breaker()
+            cirpy.disable_retries()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_download_many(self):
+        """Test that one file is written per input and existing files are skipped."""
+        directory = os.path.join(self.tempdir, 'files')
+        paths = cirpy.download_many(['Aspirin', 'Morphine', 'empty', 'busy'], directory, 'mol2')
+        self.assertEqual(paths[:3], [os.path.join(directory, 'Aspirin.mol2'), os.path.join(directory, 'Morphine.mol2'), None])
+        self.assertIsInstance(paths[3], HTTPError)
+        self.assertEqual(sorted(os.listdir(directory)), ['Aspirin.mol2', 'Morphine.mol2'])
+        StubHandler.paths = []
+        cirpy.download_many(['Aspirin', 'Morphine'], directory, 'mol2')
+        self.assertEqual(StubHandler.paths, [])
+
+
+class TestCommandLine(StubTestCase):
+    """Test the cirpy command line tool."""
+
+    def tearDown(self):
+        cirpy.disable_circuit_breaker()
+        cirpy.disable_retries()
+        cirpy.disable_cache()
+        super(TestCommandLine, self).tearDown()
+
+    def run_main(self, argv, stdin):
+        stdin_orig, stdout_orig, stderr_orig = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin, sys.stdout, sys.stderr = io.StringIO(stdin), io.StringIO(), io.StringIO()
+        try:
+            self.status = cirpy.main(argv)
+            self.stderr = sys.stderr.getvalue()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = stdin_orig, stdout_orig, stderr_orig
+
+    def test_jsonl(self):
+        """Test that results are written as JSON Lines in input order, with errors recorded."""
+        inputs = ['Aspirin%s' % i for i in range(10)] + ['', 'busy']
+        output = self.run_main(['-r', 'smiles', '-r', 'names'], '\n'.join(inputs) + '\n')
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([record['input'] for record in records], inputs[:10] + ['busy'])
+        self.assertEqual(records[0]['smiles'], 'smiles-Aspirin0')
+        self.assertEqual(records[0]['names'], ['names-Aspirin0', 'names-Aspirin0-2'])
+        self.assertIsNone(records[-1]['smiles'])
+        self.assertIn('smiles', records[-1]['errors'])
+        self.assertEqual(self.status, 1)
+        self.assertTrue(self.stderr.startswith('cirpy: busy: smiles: '))
+
+    def test_tsv(self):
+        """Test TSV output from an input file."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'inputs.txt')
+            with open(filename, 'w') as f:
+                f.write('Aspirin\nempty\n')
+            output = self.run_main(['-f', 'tsv', '-r', 'formula', '-r', 'names', filename], '')
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(output.splitlines(), [
+            'input\tformula\tnames', 'Aspirin\tformula-Aspirin\tnames-Aspirin|names-Aspirin-2', 'empty\t\t'
+        ])
+        self.assertEqual((self.status, self.stderr), (0, ''))
+
+    def test_connection_errors(self):
+        """Test that connection errors and an open circuit breaker are reported for each line."""
+        cirpy.enable_circuit_breaker(failure_threshold=1, cooldown=60)
+        output = self.run_main(['-w', '1'], 'busy\nAspirin\n')
+        self.assertEqual([list(json.loads(line)['errors']) for line in output.splitlines()], [['smiles']] * 2)
+        self.assertIn('Circuit', self.stderr.splitlines()[1])
+        cirpy.disable_circuit_breaker()
+        cirpy.API_BASE = 'http://127.0.0.1:1/chemical/structure'
+        output = self.run_main([], 'Aspirin\nMorphine\n')
+        self.assertEqual(len(output.splitlines()), 2)
+        self.assertEqual(len(self.stderr.splitlines()), 2)
+        self.assertEqual(self.status, 1)
+
+    def test_restore_configuration(self):
+        """Test that a cache and retry policy configured by the caller are restored afterwards."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            cirpy.enable_cache(os.path.join(tempdir, 'caller.sqlite'))
+            cirpy.enable_retries(max_attempts=2)
+            cache, policy = cirpy._cache, cirpy._retry_policy
+            self.run_main(['--cache', os.path.join(tempdir, 'cli.sqlite'), '--retries', '3'], 'Aspirin\n')
+            self.assertIs(cirpy._cache, cache)
+            self.assertIs(cirpy._retry_policy, policy)
+            self.assertEqual(resolve('Aspirin', 'smiles'), 'smiles-Aspirin')
+            self.assertEqual(cirpy.cache_stats()['size'], 1)
+        finally:
+            cirpy.disable_cache()
+            shutil.rmtree(tempdir)
+
+
+class TestQueryCache(StubTestCase):
+    """Test the in-memory query cache."""
+
+    def tearDown(self):
+        cirpy.configure_query_cache(0)
+        cirpy.clear_query_cache()
+        super(TestQueryCache, self).tearDown()
+
+    def test_resolve_cache(self):
+        """Test that plain text resolve results and Molecule properties are cached."""
+        cirpy.configure_query_cache(100)
+        for _ in range(3):
+            self.assertEqual(Molecule('Aspirin').smiles, 'smiles-Aspirin')
+            self.assertEqual(resolve('Aspirin', 'mw'), 'mw-Aspirin')
+        self.assertEqual(len(StubHandler.paths), 2)
+        stats = cirpy.query_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (4, 2, 2))
+
+    def test_query_cache(self):
+        """Test that repeated queries are answered from memory."""
+        cirpy.configure_query_cache(10)
+        self.assertEqual(query('Aspirin', 'smiles')[0].value, 'smiles-Aspirin')
+        self.assertEqual(Molecule('Aspirin').smiles, 'smiles-Aspirin')
+        self.assertEqual(len(StubHandler.paths), 1)
+        stats = cirpy.query_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+
+    def test_query_cache_limits(self):
+        """Test that entries are evicted by count and by size."""
+        cirpy.configure_query_cache(2)
+        for input in ('Aspirin', 'Morphine', 'Caffeine', 'Aspirin'):
+            query(input, 'smiles')
+        self.assertEqual(len(StubHandler.paths), 4)
+        cirpy.configure_query_cache(10, maxbytes=60)
+        self.assertLessEqual(cirpy.query_cache_stats()['bytes'], 60)
+        self.assertEqual(cirpy.query_cache_stats()['size'], 1)
+
+    def test_query_cache_disabled(self):
+        """Test that the query cache is disabled by default."""
+        query('Aspirin', 'smiles')
+        query('Aspirin', 'smiles')
+        self.assertEqual(len(StubHandler.paths), 2)
+
+
 class TestRequest(RateLimitTestCase):
     """Test basic requests to CIR servers return the expected XML response."""
 
@@ -108,6 +1296,63 @@ class TestQuery(RateLimitTestCase):
         self.assertNotEqual(r1, r3)
 
 
+class TestLazyImport(unittest.TestCase):
+    """Test that heavy dependencies are only imported when first needed."""
+
+    def test_lazy_import(self):
+        """Test that importing cirpy and constructing a URL does not import the deferred modules."""
+        code = ('import sys, cirpy; cirpy.construct_api_url("Aspirin", "smiles"); '
+                'print(" ".join(m for m in ("lxml.etree", "xml.etree.ElementTree", "http.client", "sqlite3", '
+                '"multiprocessing.pool") if m in sys.modules))')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(cirpy.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.strip(), b'')
+
+
+class TestResultSet(unittest.TestCase):
+    """Test the compact Result and ResultSet containers."""
+
+    def setUp(self):
+        self.results = [
+            Result('in%s' % i, 'notation', 'chemical name (CIR)', 'name_by_cir', 'smiles', 'value%s' % i) for i in range(3)
+        ] + [Result('in3', 'notation', 'chemical name (CIR)', 'name_by_cir', 'names', ['a', 'b'])]
+
+    def test_result_slots(self):
+        """Test that Result has no instance dict but keeps dict-style access."""
+        result = self.results[0]
+        self.assertFalse(hasattr(result, '__dict__'))
+        self.assertEqual(result['value'], 'value0')
+        self.assertIn('resolver', result)
+        self.assertNotIn('foo', result)
+        with self.assertRaises(KeyError):
+            result['foo']
+        self.assertEqual(result.to_dict()['input'], 'in0')
+        self.assertEqual(pickle.loads(pickle.dumps(result)), result)
+
+    def test_result_set(self):
+        """Test that a ResultSet returns equal Results and interns repeated strings."""
+        result_set = cirpy.ResultSet(self.results)
+        self.assertEqual(len(result_set), 4)
+        self.assertEqual(list(result_set), self.results)
+        self.assertEqual(result_set[-1], self.results[-1])
+        self.assertEqual(list(result_set[1:3]), self.results[1:3])
+        self.assertEqual(result_set.column('value')[:2], ['value0', 'value1'])
+        resolvers = result_set.column('resolver')
+        self.assertTrue(all(resolver is resolvers[0] for resolver in resolvers))
+
+    def test_export(self):
+        """Test CSV and JSON Lines export."""
+        result_set = cirpy.ResultSet(self.results)
+        f = io.StringIO()
+        result_set.to_jsonl(f)
+        lines = f.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[3])['value'], ['a', 'b'])
+        f = io.StringIO()
+        result_set.to_csv(f)
+        self.assertTrue(f.getvalue().startswith('input,representation,resolver,input_format,notation,value'))
+
+
 class TestResolve(RateLimitTestCase):
     """Test the resolve function."""
 
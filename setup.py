@@ -17,11 +17,12 @@ setup(
     author_email='m.swain@me.com',
     license='MIT',
     url='https://github.com/mcs07/CIRpy',
-    py_modules=['cirpy'],
+    py_modules=['cirpy', 'cirpy_async'],
     description='Python wrapper for the NCI Chemical Identifier Resolver (CIR).',
     long_description=long_description,
     keywords='python rest api chemistry cheminformatics',
     extras_require={'lxml': ['lxml']},
+    entry_points={'console_scripts': ['cirpy = cirpy:main']},
     test_suite='cirpy_test',
     classifiers=[
         'Intended Audience :: Science/Research',